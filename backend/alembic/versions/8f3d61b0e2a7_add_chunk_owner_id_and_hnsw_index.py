@@ -0,0 +1,51 @@
+"""add chunks.owner_id and HNSW index on chunks.embedding
+
+Revision ID: 8f3d61b0e2a7
+Revises: 4b7e2a9c1d03
+Create Date: 2026-10-17 10:04:51.330912
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3d61b0e2a7'
+down_revision: Union[str, Sequence[str], None] = '4b7e2a9c1d03'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # 1. Denormalized owner_id (เติมค่าจาก documents ให้แถวเดิม)
+    op.add_column('chunks', sa.Column('owner_id', sa.Integer(), nullable=True))
+    op.execute("""
+        UPDATE chunks
+        SET owner_id = documents.owner_id
+        FROM documents
+        WHERE chunks.document_id = documents.id
+    """)
+    op.create_foreign_key('chunks_owner_id_fkey', 'chunks', 'users', ['owner_id'], ['id'])
+    op.create_index(op.f('ix_chunks_owner_id'), 'chunks', ['owner_id'], unique=False)
+
+    # 2. ANN Index (HNSW, L2) -- ใช้กับ ORDER BY embedding <-> query
+    op.create_index(
+        'ix_chunks_embedding_hnsw',
+        'chunks',
+        ['embedding'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embedding': 'vector_l2_ops'},
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chunks_embedding_hnsw', table_name='chunks')
+    op.drop_index(op.f('ix_chunks_owner_id'), table_name='chunks')
+    op.drop_constraint('chunks_owner_id_fkey', 'chunks', type_='foreignkey')
+    op.drop_column('chunks', 'owner_id')
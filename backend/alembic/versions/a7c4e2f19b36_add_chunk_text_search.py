@@ -0,0 +1,40 @@
+"""add generated tsvector column and GIN index to chunks
+
+Revision ID: a7c4e2f19b36
+Revises: d91c7e5a3f28
+Create Date: 2026-10-17 14:05:41.318520
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c4e2f19b36'
+down_revision: Union[str, Sequence[str], None] = 'd91c7e5a3f28'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Generated Column -> Postgres เติมค่าให้แถวเดิมเอง (Rewrite ตาราง 1 รอบ)
+    op.add_column(
+        'chunks',
+        sa.Column(
+            'text_search',
+            postgresql.TSVECTOR(),
+            sa.Computed("to_tsvector('english', text)", persisted=True),
+            nullable=True,
+        )
+    )
+    op.create_index('ix_chunks_text_search', 'chunks', ['text_search'], unique=False, postgresql_using='gin')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_chunks_text_search', table_name='chunks')
+    op.drop_column('chunks', 'text_search')
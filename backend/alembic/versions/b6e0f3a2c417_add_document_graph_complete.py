@@ -0,0 +1,32 @@
+"""add graph_complete to documents
+
+Revision ID: b6e0f3a2c417
+Revises: a7c4e2f19b36
+Create Date: 2026-10-17 18:12:05.413920
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e0f3a2c417'
+down_revision: Union[str, Sequence[str], None] = 'a7c4e2f19b36'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # เอกสารเดิมไม่รู้ว่ากราฟครบหรือไม่ -> false (ไม่ใช้เป็นต้นฉบับ Dedup, ไฟล์เดียวกันรอบหน้าประมวลผลใหม่)
+    op.add_column(
+        'documents',
+        sa.Column('graph_complete', sa.Boolean(), server_default=sa.false(), nullable=False)
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('documents', 'graph_complete')
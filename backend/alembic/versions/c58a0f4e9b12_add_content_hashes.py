@@ -0,0 +1,37 @@
+"""add content hashes to documents and chunks
+
+Revision ID: c58a0f4e9b12
+Revises: 8f3d61b0e2a7
+Create Date: 2026-10-17 10:47:22.904117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c58a0f4e9b12'
+down_revision: Union[str, Sequence[str], None] = '8f3d61b0e2a7'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('documents', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_documents_content_hash'), 'documents', ['content_hash'], unique=False)
+
+    op.add_column('chunks', sa.Column('content_hash', sa.String(length=64), nullable=True))
+    # Backfill ให้ Chunks เดิม (ตรงกับ hashlib.sha256(text.encode("utf-8")).hexdigest())
+    op.execute("UPDATE chunks SET content_hash = encode(sha256(convert_to(text, 'UTF8')), 'hex')")
+    op.create_index(op.f('ix_chunks_content_hash'), 'chunks', ['content_hash'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chunks_content_hash'), table_name='chunks')
+    op.drop_column('chunks', 'content_hash')
+    op.drop_index(op.f('ix_documents_content_hash'), table_name='documents')
+    op.drop_column('documents', 'content_hash')
@@ -0,0 +1,75 @@
+import logging
+import re
+from collections import defaultdict
+import numpy as np
+from app import metrics
+from app.cache import LRUCache
+from app.config import settings
+
+log = logging.getLogger("uvicorn.error")
+
+# Semantic Answer Cache (In-process)
+# Key = (user_id, doc scope, retrieval variant, ตัวเลขในคำถาม, corpus version) -> รายการ (question vector, answer, context)
+# คำถามใหม่ที่ Cosine Similarity >= threshold กับคำถามเดิม (และตัวเลขตรงกันทุกตัว) จะได้คำตอบเดิมทันที
+# corpus version ของ User จะเพิ่มทุกครั้งที่เอกสารถูกเพิ่ม/ประมวลผลเสร็จ/ลบ -> Cache เก่าใช้ไม่ได้อัตโนมัติ
+
+_corpus_versions: dict[int, int] = defaultdict(int)
+_scopes = LRUCache(settings.ANSWER_CACHE_MAX_SCOPES, name="answer_cache_scope")
+
+
+def bump_corpus_version(user_id: int):
+    _corpus_versions[user_id] += 1
+    log.info(f"🔄 Corpus version for user {user_id} -> {_corpus_versions[user_id]}")
+
+
+_NUMBER_PATTERN = re.compile(r"\d+(?:[.,]\d+)*")
+
+
+def _query_numbers(query_text: str) -> tuple:
+    """
+    ตัวเลขในคำถาม (ปี, ไตรมาส, จำนวนเงิน, %) -- "revenue in 2022" กับ "revenue in 2023"
+    Embedding แทบเหมือนกันแต่คำตอบต่างกัน -> ต้องตรงกันทุกตัวถึงจะใช้คำตอบเดิมได้
+    """
+    return tuple(sorted(number.replace(",", "") for number in _NUMBER_PATTERN.findall(query_text)))
+
+
+def _scope_key(user_id: int, doc_id: int | None, query_text: str, variant: tuple) -> tuple:
+    return (user_id, doc_id, variant, _query_numbers(query_text), _corpus_versions[user_id])
+
+
+def _unit(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def lookup(
+    user_id: int, doc_id: int | None, query_text: str, query_embedding, variant: tuple = ()
+) -> tuple[str, list] | None:
+    """
+    คืนค่า (answer, context_chunks) ของคำถามที่ใกล้เคียงที่สุด ถ้าผ่าน threshold
+    variant = ค่าที่ทำให้คำตอบต่างกันได้ (เช่น Retrieval options) -- ต้องตรงกันทุกตัว
+    """
+    entries = _scopes.get(_scope_key(user_id, doc_id, query_text, variant))
+    if entries:
+        query = _unit(query_embedding)
+        similarities = np.stack([entry[0] for entry in entries]) @ query
+        best = int(np.argmax(similarities))
+        if similarities[best] >= settings.ANSWER_CACHE_SIMILARITY_THRESHOLD:
+            metrics.incr("answer_cache.hit")
+            log.info(f"⚡ Answer cache hit (similarity {similarities[best]:.3f})")
+            _, answer, context = entries[best]
+            return answer, context
+
+    metrics.incr("answer_cache.miss")
+    return None
+
+
+def store(
+    user_id: int, doc_id: int | None, query_text: str, query_embedding, answer: str, context: list, variant: tuple = ()
+):
+    key = _scope_key(user_id, doc_id, query_text, variant)
+    entries = _scopes.get(key) or []
+    entries.append((_unit(query_embedding), answer, context))
+    # เก็บเฉพาะคำถามล่าสุดของ Scope นี้
+    _scopes.put(key, entries[-settings.ANSWER_CACHE_MAX_PER_SCOPE:])
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+from app import metrics
+
+
+class LRUCache:
+    """
+    Cache แบบ LRU ขนาดจำกัด (In-process) -- นับ hit/miss ลง app.metrics ด้วยชื่อ "<name>.hit" / "<name>.miss"
+    ใช้จาก Event Loop เท่านั้น (ไม่ได้ Lock สำหรับหลาย Thread)
+    weigh: ขนาดของแต่ละค่า (Default = 1 -> maxsize คือจำนวน Key) -- ค่าที่ใส่ล่าสุดไม่ถูก Evict แม้ใหญ่เกิน maxsize
+    """
+    def __init__(self, maxsize: int, name: str, weigh: Callable[[Any], int] | None = None):
+        self.maxsize = maxsize
+        self.name = name
+        self._data: OrderedDict = OrderedDict()
+        self._weigh = weigh
+        self._weights: dict = {}
+        self.total_weight = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key in self._data:
+            self._data.move_to_end(key)
+            metrics.incr(f"{self.name}.hit")
+            return self._data[key]
+        metrics.incr(f"{self.name}.miss")
+        return default
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        weight = self._weigh(value) if self._weigh else 1
+        self.total_weight += weight - self._weights.get(key, 0)
+        self._weights[key] = weight
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while self.total_weight > self.maxsize and len(self._data) > 1:
+            evicted, _ = self._data.popitem(last=False)
+            self.total_weight -= self._weights.pop(evicted)
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """อ่านโดยไม่นับ hit/miss และไม่เลื่อนลำดับ LRU"""
+        return self._data.get(key, default)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        self.total_weight -= self._weights.pop(key, 0)
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+        self._weights.clear()
+        self.total_weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,79 @@
+import logging
+import time
+import sqlalchemy as sa
+from psycopg.types import TypeInfo
+from pgvector.psycopg.vector import register_vector_info
+from app.config import settings
+from app.database import engine
+
+log = logging.getLogger("uvicorn.error")
+
+# เขียนตรงด้วย COPY (Binary) -- models.Chunk ยังเป็น Read Model เหมือนเดิม
+COPY_CHUNKS_SQL = "COPY chunks (text, embedding, document_id, owner_id, content_hash) FROM STDIN WITH (FORMAT BINARY)"
+COPY_CHUNK_TYPES = ["text", "vector", "int4", "int4", "text"]
+
+
+async def bulk_write_chunks(
+    document_id: int,
+    owner_id: int,
+    texts: list[str],
+    embeddings,
+    hashes: list[str],
+    batch_size: int | None = None
+) -> int:
+    """
+    บันทึก Chunks + Vectors ของเอกสารด้วย PostgreSQL COPY protocol
+    - ลบ Chunks เดิมของเอกสารนี้ก่อน (กรณี Retry) ใน Transaction เดียวกัน
+    - ส่งทีละ batch_size แถว (1 COPY ต่อ batch)
+    คืนค่าจำนวนแถวที่เขียน
+    """
+    batch_size = batch_size or settings.CHUNK_COPY_BATCH_SIZE
+    total = len(texts)
+    start = time.perf_counter()
+
+    async with engine.begin() as conn:
+        # ใช้ Connection ของ psycopg ที่อยู่หลัง SQLAlchemy โดยตรง
+        raw_conn = await conn.get_raw_connection()
+        pg_conn = raw_conn.driver_connection
+
+        vector_info = await TypeInfo.fetch(pg_conn, "vector")
+        async with pg_conn.cursor() as cur:
+            # Register เฉพาะ Cursor นี้ ไม่ไปยุ่งกับ Adapter ของ Connection ใน Pool
+            register_vector_info(cur, vector_info)
+
+            await cur.execute("DELETE FROM chunks WHERE document_id = %s", (document_id,))
+
+            for batch_start in range(0, total, batch_size):
+                batch_end = min(batch_start + batch_size, total)
+                async with cur.copy(COPY_CHUNKS_SQL) as copy:
+                    copy.set_types(COPY_CHUNK_TYPES)
+                    for i in range(batch_start, batch_end):
+                        await copy.write_row((texts[i], embeddings[i], document_id, owner_id, hashes[i]))
+
+    elapsed = time.perf_counter() - start
+    rate = total / elapsed if elapsed > 0 else float(total)
+    log.info(f"💾 COPY wrote {total} chunks for Doc ID: {document_id} in {elapsed:.2f}s ({rate:,.0f} rows/sec)")
+    return total
+
+
+async def copy_document_chunks(source_document_id: int, document_id: int, owner_id: int) -> int:
+    """
+    Dedup: คัดลอก Chunks (text + embedding) จากเอกสารที่มีเนื้อหาเหมือนกัน ภายใน Database เลย
+    """
+    async with engine.begin() as conn:
+        await conn.execute(
+            sa.text("DELETE FROM chunks WHERE document_id = :document_id"),
+            {"document_id": document_id}
+        )
+        result = await conn.execute(
+            sa.text("""
+                INSERT INTO chunks (text, embedding, document_id, owner_id, content_hash)
+                SELECT text, embedding, :document_id, :owner_id, content_hash
+                FROM chunks
+                WHERE document_id = :source_document_id
+                ORDER BY id
+            """),
+            {"document_id": document_id, "owner_id": owner_id, "source_document_id": source_document_id}
+        )
+    log.info(f"♻️ Copied {result.rowcount} chunks from Doc ID: {source_document_id} -> {document_id}")
+    return result.rowcount
@@ -34,5 +34,99 @@ class Settings(BaseSettings):
 
     SEC_API_EMAIL: str = "phuminunsk141@gamail.com"
 
+    # --- 5. Ingestion Job Queue Settings ---
+    INGESTION_WORKERS: int = 2                      # จำนวนงาน ingestion ที่รันพร้อมกันได้สูงสุด
+    INGESTION_MAX_ATTEMPTS: int = 3
+    INGESTION_RETRY_BACKOFF_SECONDS: float = 30.0   # x2 ทุกครั้งที่ retry
+    INGESTION_POLL_INTERVAL_SECONDS: float = 2.0
+
+    # --- 6. Embedding Service Settings ---
+    EMBEDDING_BATCH_MAX_SIZE: int = 32        # จำนวนคำถามสูงสุดที่รวมเป็น encode() เดียว
+    EMBEDDING_BATCH_MAX_WAIT_MS: float = 5.0  # รอรวม batch ได้นานสุดกี่ ms
+    EMBEDDING_INGEST_BATCH_SIZE: int = 64     # batch_size ตอน encode chunks ของเอกสาร
+    QUERY_EMBEDDING_CACHE_SIZE: int = 10000   # LRU ของ Vector คำถาม (key = normalized question)
+    QUERY_EMBEDDING_SHARED_CACHE: bool = False # แชร์ Vector คำถามข้าม Process/Replica ผ่านตาราง llm_cache
+
+    # Reranker (Cross-Encoder): รวม (query, chunk) pairs จากหลาย request + Cache คะแนน
+    RERANK_BATCH_MAX_SIZE: int = 64           # จำนวน pairs สูงสุดต่อ predict() ครั้งเดียว
+    RERANK_BATCH_MAX_WAIT_MS: float = 5.0
+    RERANK_CACHE_SIZE: int = 50000            # จำนวน (query, chunk id) -> score ที่จำไว้
+
+    # --- 7. Chunk Storage Settings ---
+    CHUNK_COPY_BATCH_SIZE: int = 1000 # จำนวนแถวต่อ 1 COPY ตอนบันทึก Chunks
+
+    # --- 8. Vector Search Settings (pgvector HNSW) ---
+    HNSW_EF_SEARCH: int = 40                      # Default ef_search (ปรับต่อ Request ได้)
+    HNSW_ITERATIVE_SCAN: str = "relaxed_order"    # off / strict_order / relaxed_order
+    # Hybrid Retrieval: Vector (HNSW) + Lexical (tsvector) รวมอันดับด้วย Reciprocal Rank Fusion
+    HYBRID_SEARCH_ENABLED: bool = True
+    HYBRID_VECTOR_CANDIDATES: int = 20
+    HYBRID_LEXICAL_CANDIDATES: int = 20
+    HYBRID_RRF_K: int = 60
+    RERANK_CANDIDATES: int = 10                   # จำนวนที่ส่งให้ Cross-Encoder หลัง Fusion
+    RETRIEVAL_TOP_K: int = 5                      # จำนวน Chunks ที่ส่งเข้า Prompt
+    # Rerank mode: on / off / auto (auto = ข้ามหรือลดจำนวนที่ Rerank เมื่อ Vector Distance ชี้ขาดชัดเจน)
+    RERANK_MODE: str = "auto"
+    RERANK_AUTO_SKIP_GAP: float = 0.15            # อันดับ 1 ห่างอันดับ 2 (L2) อย่างน้อยเท่านี้ -> ไม่ต้อง Rerank
+    RERANK_AUTO_WINDOW: float = 0.3               # Rerank เฉพาะ Candidates ที่ห่างจากอันดับ 1 ไม่เกินนี้
+
+    # --- 9. LLM Rate Limits (Graph Extraction) ---
+    # ต่อ Provider -- ควรตั้งต่ำกว่า Quota จริงเล็กน้อย เผื่อให้การตอบคำถามของผู้ใช้
+    # ตั้งผ่าน .env เป็น JSON ได้ เช่น LLM_RATE_LIMITS='{"groq": {"requests_per_minute": 30, "tokens_per_minute": 6000}}'
+    LLM_RATE_LIMITS: dict[str, dict[str, int]] = {
+        "groq": {"requests_per_minute": 25, "tokens_per_minute": 5000},
+        "openai": {"requests_per_minute": 450, "tokens_per_minute": 180000},
+    }
+    LLM_DEFAULT_REQUESTS_PER_MINUTE: int = 30
+    LLM_DEFAULT_TOKENS_PER_MINUTE: int = 10000
+    LLM_RATE_LIMIT_MAX_RETRIES: int = 5           # จำนวนครั้งที่ลองใหม่เมื่อโดน 429
+    GRAPH_EXTRACTION_CONCURRENCY: int = 4         # จำนวน LLM call ที่ยิงพร้อมกันต่อเอกสาร
+    GRAPH_MAX_CHUNKS_PER_DOCUMENT: int = 0        # 0 = ทุก Chunk
+    GRAPH_EXTRACTION_MAX_OUTPUT_TOKENS: int = 1024
+    GRAPH_EXTRACTION_MAX_ATTEMPTS: int = 3        # ต่อ Chunk เมื่อเจอ Error ชั่วคราว (Timeout, 5xx, JSON พัง)
+
+    # Packed Mode: หลาย Chunk ต่อ 1 LLM Request
+    GRAPH_PACKED_EXTRACTION: bool = True
+    GRAPH_PACK_MAX_CHUNKS: int = 6
+    GRAPH_PACK_TOKEN_BUDGET: int = 2000           # งบ Token ของเนื้อหา Chunk ต่อ Request
+    GRAPH_PACK_MAX_OUTPUT_TOKENS: int = 4096
+    GRAPH_PACK_OUTPUT_TOKENS_PER_CHUNK: int = 600 # จอง Output ต่อ Chunk (Pack ต้องพอดี Bucket ของ Provider)
+
+    # --- 10. Semantic Answer Cache (In-process) ---
+    ANSWER_CACHE_ENABLED: bool = True
+    ANSWER_CACHE_SIMILARITY_THRESHOLD: float = 0.95   # Cosine Similarity ขั้นต่ำของคำถาม
+    ANSWER_CACHE_MAX_PER_SCOPE: int = 200             # จำนวนคำตอบต่อ (user, doc scope)
+    ANSWER_CACHE_MAX_SCOPES: int = 1000
+
+    # --- 11. LLM Response Cache (Postgres) ---
+    LLM_CACHE_TTL_DAYS: int = 30
+    LLM_CACHE_MAX_MB: int = 512
+
+    # --- 12. Query Pipeline Settings ---
+    # Retrieval (Vector + Rerank) กับ Graph Context ทำพร้อมกัน -- เกินเวลาแล้วตอบต่อโดยไม่มีส่วนนั้น
+    QUERY_RETRIEVAL_TIMEOUT_SECONDS: float = 10.0
+    QUERY_GRAPH_TIMEOUT_SECONDS: float = 5.0
+    BATCH_QUERY_LLM_CONCURRENCY: int = 4       # Batch endpoint: จำนวนคำถามที่เรียก LLM พร้อมกัน
+
+    # --- 13. GraphRAG Entity Matching ---
+    ENTITY_MATCHER_MAX_PATTERNS: int = 250000  # จำนวนชื่อ Entity รวมทุก User ใน Memory (~0.5 KB ต่อชื่อ)
+    ENTITY_MATCHER_MIN_ALIAS_LENGTH: int = 3   # ชื่อสั้นกว่านี้ (เช่น "AI", "IT") ไม่ใช้จับคู่
+    ENTITY_MATCHER_PENDING_MAX: int = 10000    # ชื่อใหม่ที่ยังไม่รวมเข้า Automaton หลัก (รวมใน Thread เมื่อครบ)
+    GRAPH_QUERY_MAX_ENTITIES: int = 10
+    GRAPH_QUERY_LLM_FALLBACK: bool = True      # ไม่เจอ Entity ใน Dictionary -> ให้ LLM ช่วยดึงคำ
+    GRAPH_QUERY_NODES_PER_TERM: int = 3        # Full-text: จำนวน Entity ที่ดีที่สุดต่อ 1 คำค้น
+    GRAPH_QUERY_NEIGHBORS_PER_ENTITY: int = 8  # จำกัด Fan-out ต่อ Entity (กัน Entity ยอดนิยมกินโควตาหมด)
+    GRAPH_QUERY_MAX_HOPS: int = 2              # ความลึกของ Path (1 = เฉพาะเพื่อนบ้านโดยตรง)
+    GRAPH_QUERY_FANOUT_PER_HOP: int = 4        # จำกัด Fan-out ต่อ Node ใน Hop ที่ 2 เป็นต้นไป
+    GRAPH_QUERY_MAX_PATHS: int = 30
+    GRAPH_CONTEXT_TOKEN_BUDGET: int = 800      # ขนาดสูงสุดของ Graph Context ใน Prompt (ประมาณ Token)
+
+    # --- 14. Graph API Settings ---
+    GRAPH_PAGE_SIZE: int = 1000                # Edges ต่อหน้าของ GET /documents/{id}/graph
+    GRAPH_PAGE_MAX_SIZE: int = 5000
+    GRAPH_CACHE_MAX_PAGES: int = 256           # จำนวนหน้า Graph (JSON) ที่ Cache ไว้ใน Memory
+    GRAPH_CACHE_MAX_VERSIONS: int = 10000      # จำนวน User ที่จำ Version ของกราฟไว้ (ใช้ทำ ETag)
+    GRAPH_DELETE_BATCH_SIZE: int = 5000        # แถวต่อ Transaction ตอนลบกราฟของเอกสาร
+
 # Create instance to import elsewhere
 settings = Settings()
\ No newline at end of file
@@ -1,11 +1,17 @@
 import asyncio
+import logging
 import os
+import time
 import sqlalchemy as sa
 from fastapi import HTTPException, UploadFile
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import crud, models, processing, sec_service
+from app import crud, models, schemas, processing, job_queue, answer_cache, graph_cache
+from app.config import settings
+from app.utils import elapsed_ms, content_hash
 from app.processing import UPLOAD_DIRECTORY
-from app.knowledge_graph import get_document_graph, delete_document_graph
+from app.knowledge_graph import get_document_graph
+
+log = logging.getLogger("uvicorn.error")
 
 async def create_document(
     db: AsyncSession, 
@@ -22,18 +28,20 @@ async def create_document(
         owner_id=current_user.id
     )
 
-    # 3. Process document (extract, chunk, embed, save) in background
-    asyncio.create_task(
-        processing.save_extract_chunk_and_embed( 
-            document_id=db_doc.id,
-            user_id=current_user.id,
-            filename=file.filename,
-            content_type=file.content_type,
-            content=content
-        )
+    # 3. Queue processing (extract, chunk, embed, save) -- Worker Pool จะหยิบไปทำ
+    await job_queue.enqueue_job(
+        db=db,
+        kind="ingest_upload",
+        user_id=current_user.id,
+        document_id=db_doc.id,
+        payload={"filename": file.filename, "content_type": file.content_type},
+        content=content
     )
 
-    # 4. Return immediately
+    # 4. Corpus ของ User เปลี่ยน -> Answer Cache เดิมใช้ไม่ได้
+    answer_cache.bump_corpus_version(current_user.id)
+
+    # 5. Return immediately
     return db_doc
 
 async def get_documents(db: AsyncSession, current_user: models.User):
@@ -71,7 +79,8 @@ async def query_document(
     doc_id: int,
     query_text: str,
     db: AsyncSession,
-    current_user: models.User
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
 ):
     # 1. Check ownership
     stmt_doc = (
@@ -83,42 +92,241 @@ async def query_document(
     if result_doc.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    # 2. Retrieve relevant chunks
-    relevant_chunks = await processing.retrieve_relevant_chunks(
-        document_id=doc_id,
-        query_text=query_text
+    # 2. Cache -> (Retrieval || Graph Context) -> Generate answer
+    return await _answer_query(current_user.id, doc_id, query_text, options)
+
+async def query_all_documents(
+    query_text: str,
+    db: AsyncSession,
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
+):
+    # Scope = ทุกเอกสารของ User (doc_id=None)
+    return await _answer_query(current_user.id, None, query_text, options)
+
+async def _answer_query(user_id: int, doc_id: int | None, query_text: str, options: schemas.RetrievalOptions | None):
+    """
+    คืนค่า (answer, relevant_chunks, timings) -- timings เป็นเวลาแต่ละขั้น (ms)
+    """
+    started = time.perf_counter()
+    timings = {}
+
+    # 1. Semantic Answer Cache (คำถามใกล้เคียงใน Corpus version เดิม)
+    query_embedding = await processing.embedding_service.embed_query(query_text)
+    cached = _lookup_cached_answer(user_id, doc_id, query_text, query_embedding, options)
+    if cached:
+        answer, relevant_chunks = cached
+        timings["total_ms"] = elapsed_ms(started)
+        return answer, relevant_chunks, timings
+
+    # 2. Retrieve relevant chunks + Graph Context (พร้อมกัน)
+    relevant_chunks, graph_context = await processing.gather_query_context(
+        query_text, user_id, doc_id, options, timings
     )
 
     # 3. Generate answer
+    generation_started = time.perf_counter()
     answer = await processing.generate_answer(
         query=query_text,
         context_chunks=relevant_chunks,
-        user_id=current_user.id,
-        doc_id=doc_id
+        user_id=user_id,
+        doc_id=doc_id,
+        graph_context=graph_context
     )
+    timings["generation_ms"] = elapsed_ms(generation_started)
+    timings["total_ms"] = elapsed_ms(started)
 
-    return answer, relevant_chunks
+    _store_cached_answer(user_id, doc_id, query_text, query_embedding, answer, relevant_chunks, options)
+    return answer, relevant_chunks, timings
 
-async def query_all_documents(
+async def query_document_batch(
+    doc_id: int,
+    questions: list[str],
+    db: AsyncSession,
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
+):
+    # 1. Check ownership
+    stmt_doc = (
+        sa.select(models.Document)
+        .where(models.Document.id == doc_id)
+        .where(models.Document.owner_id == current_user.id)
+    )
+    result_doc = await db.execute(stmt_doc)
+    if result_doc.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # 2. ตอบทุกข้อ
+    return await _answer_batch(current_user.id, doc_id, questions, options)
+
+async def query_all_documents_batch(
+    questions: list[str],
+    db: AsyncSession,
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
+):
+    return await _answer_batch(current_user.id, None, questions, options)
+
+async def _answer_batch(user_id: int, doc_id: int | None, questions: list[str], options: schemas.RetrievalOptions | None):
+    """
+    คืนค่า (results, timings) -- results[i] = (answer, relevant_chunks, timings ของข้อนั้น)
+    Embedding/Retrieval/Rerank ทำทีเดียวทั้งชุด ส่วน LLM เรียกพร้อมกันไม่เกิน BATCH_QUERY_LLM_CONCURRENCY
+    """
+    started = time.perf_counter()
+    timings = {}
+
+    # 1. Embed ทุกคำถามครั้งเดียว แล้วเช็ก Semantic Answer Cache
+    query_embeddings = await processing.embedding_service.embed_queries(questions)
+    results = [None] * len(questions)
+    pending = []
+    for i, query_embedding in enumerate(query_embeddings):
+        cached = _lookup_cached_answer(user_id, doc_id, questions[i], query_embedding, options)
+        if cached:
+            answer, relevant_chunks = cached
+            results[i] = (answer, relevant_chunks, {})
+        else:
+            pending.append(i)
+    timings["cache_hits"] = len(questions) - len(pending)
+
+    if pending:
+        # 2. Retrieval ทั้งชุด (DB Session เดียว + Rerank ครั้งเดียว)
+        retrieval_started = time.perf_counter()
+        chunk_lists = await processing.retrieve_relevant_chunks_batch(
+            [questions[i] for i in pending], user_id, doc_id, options
+        )
+        timings["retrieval_ms"] = elapsed_ms(retrieval_started)
+
+        # 3. Graph Context + Generate answer ต่อข้อ (จำกัดจำนวน LLM Call พร้อมกัน)
+        semaphore = asyncio.Semaphore(settings.BATCH_QUERY_LLM_CONCURRENCY)
+
+        async def answer_one(i: int, relevant_chunks: list):
+            item_timings = {}
+            async with semaphore:
+                graph_context = await processing.fetch_graph_context(questions[i], user_id, doc_id, item_timings)
+                generation_started = time.perf_counter()
+                answer = await processing.generate_answer(
+                    query=questions[i],
+                    context_chunks=relevant_chunks,
+                    user_id=user_id,
+                    doc_id=doc_id,
+                    graph_context=graph_context
+                )
+                item_timings["generation_ms"] = elapsed_ms(generation_started)
+            _store_cached_answer(user_id, doc_id, questions[i], query_embeddings[i], answer, relevant_chunks, options)
+            results[i] = (answer, relevant_chunks, item_timings)
+
+        await asyncio.gather(*(answer_one(i, chunks) for i, chunks in zip(pending, chunk_lists)))
+
+    timings["total_ms"] = elapsed_ms(started)
+    return results, timings
+
+async def stream_query_document(
+    doc_id: int,
     query_text: str,
     db: AsyncSession,
-    current_user: models.User
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
 ):
-    # 1. Retrieve relevant chunks from all user's documents
-    relevant_chunks = await processing.retrieve_relevant_chunks_global(
-        user_id=current_user.id,
-        query_text=query_text
+    # 1. Check ownership (ก่อนเริ่ม Stream เพื่อให้ตอบ 404 ได้ตามปกติ)
+    stmt_doc = (
+        sa.select(models.Document)
+        .where(models.Document.id == doc_id)
+        .where(models.Document.owner_id == current_user.id)
     )
-    
-    # 2. Generate answer
-    answer = await processing.generate_answer(
+    result_doc = await db.execute(stmt_doc)
+    if result_doc.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # 2. Retrieval + Generation ทำใน Generator (Session ของ Request ไม่ถูกใช้ต่อ)
+    return _stream_answer_events(current_user.id, doc_id, query_text, options)
+
+async def stream_query_all_documents(
+    query_text: str,
+    db: AsyncSession,
+    current_user: models.User,
+    options: schemas.RetrievalOptions | None = None
+):
+    return _stream_answer_events(current_user.id, None, query_text, options)
+
+async def _stream_answer_events(user_id: int, doc_id: int | None, query_text: str, options: schemas.RetrievalOptions | None):
+    """
+    yield (event, data): "context" (Chunks) -> "token" (ข้อความทีละส่วน) ... -> "done" (timings)
+    Error หลังส่ง Header ไปแล้วเปลี่ยน Status Code ไม่ได้ -> ส่ง "error" เป็น Event สุดท้ายแทน (ไม่งั้น Client เห็นแค่ Stream ขาด)
+    """
+    try:
+        async for event in _answer_events(user_id, doc_id, query_text, options):
+            yield event
+    except Exception as e:
+        log.error(f"Streaming query failed (doc_id={doc_id}): {e}")
+        yield "error", {"detail": processing.ANSWER_ERROR_MESSAGE}
+
+async def _answer_events(user_id: int, doc_id: int | None, query_text: str, options: schemas.RetrievalOptions | None):
+    started = time.perf_counter()
+    timings = {}
+
+    query_embedding = await processing.embedding_service.embed_query(query_text)
+    cached = _lookup_cached_answer(user_id, doc_id, query_text, query_embedding, options)
+    if cached:
+        answer, relevant_chunks = cached
+        yield "context", relevant_chunks
+        yield "token", answer
+        timings["total_ms"] = elapsed_ms(started)
+        yield "done", {"timings": timings}
+        return
+
+    relevant_chunks, graph_context = await processing.gather_query_context(
+        query_text, user_id, doc_id, options, timings
+    )
+    yield "context", relevant_chunks
+
+    generation_started = time.perf_counter()
+    parts = []
+    async for delta in processing.stream_answer(
         query=query_text,
         context_chunks=relevant_chunks,
-        user_id=current_user.id,
-        doc_id=None
-    )
-    
-    return answer, relevant_chunks
+        user_id=user_id,
+        doc_id=doc_id,
+        graph_context=graph_context
+    ):
+        if not parts:
+            timings["first_token_ms"] = elapsed_ms(started)
+        parts.append(delta)
+        yield "token", delta
+    timings["generation_ms"] = elapsed_ms(generation_started)
+    timings["total_ms"] = elapsed_ms(started)
+    yield "done", {"timings": timings}
+
+    _store_cached_answer(user_id, doc_id, query_text, query_embedding, "".join(parts), relevant_chunks, options)
+
+def _cache_variant(options: schemas.RetrievalOptions | None) -> tuple:
+    # Retrieval options ต่างกัน -> Context/คำตอบต่างกันได้ -> แยก Cache
+    options = options or schemas.RetrievalOptions()
+    return tuple(getattr(options, field) for field in schemas.RetrievalOptions.model_fields)
+
+def _lookup_cached_answer(
+    user_id: int,
+    doc_id: int | None,
+    query_text: str,
+    query_embedding,
+    options: schemas.RetrievalOptions | None
+):
+    if not settings.ANSWER_CACHE_ENABLED:
+        return None
+    return answer_cache.lookup(user_id, doc_id, query_text, query_embedding, _cache_variant(options))
+
+def _store_cached_answer(
+    user_id: int,
+    doc_id: int | None,
+    query_text: str,
+    query_embedding,
+    answer: str,
+    chunks: list,
+    options: schemas.RetrievalOptions | None
+):
+    # ไม่ Cache คำตอบที่ Error หรือไม่มี Context (เช่น เอกสารยังประมวลผลไม่เสร็จ)
+    if not settings.ANSWER_CACHE_ENABLED or not chunks or answer.endswith(processing.ANSWER_ERROR_MESSAGE):
+        return
+    answer_cache.store(user_id, doc_id, query_text, query_embedding, answer, chunks, _cache_variant(options))
 
 async def delete_document(
     doc_id: int,
@@ -142,16 +350,72 @@ async def delete_document(
     if os.path.exists(file_path):
         os.remove(file_path)
         
-    # 3. Delete graph from Neo4j
-    try:
-        await delete_document_graph(doc_id, current_user.id)
-    except Exception as e:
-        print(f"⚠️ Failed to delete graph: {e}")
+    # 3. Cancel queued ingestion jobs
+    await job_queue.cancel_document_jobs(db, doc_id)
+
+    # 4. Delete graph from Neo4j -- ทำใน Background Job (กราฟใหญ่ใช้เวลานาน, Retry ได้ถ้า Neo4j ล่ม)
+    await job_queue.enqueue_job(
+        db=db,
+        kind="graph_cleanup",
+        user_id=current_user.id,
+        document_id=doc_id
+    )
 
-    # 4. Delete from Database
+    # 5. Delete from Database
     await crud.delete_document(db, doc_id)
 
+    # 6. Corpus ของ User เปลี่ยน -> Answer Cache เดิมใช้ไม่ได้
+    answer_cache.bump_corpus_version(current_user.id)
+
 async def get_graph_data(
+    doc_id: int,
+    db: AsyncSession,
+    current_user: models.User,
+    cursor: str | None = None,
+    limit: int | None = None,
+    if_none_match: str | None = None,
+    media_type: str = graph_cache.JSON_MEDIA_TYPE
+):
+    """
+    คืนค่า (etag, body) -- body = None แปลว่า Client มีเวอร์ชันล่าสุดแล้ว (304)
+    etag = None ระหว่างที่เอกสารยังประมวลผลอยู่ (กราฟยังเปลี่ยนได้ ไม่ Cache)
+    """
+    # 1. Check ownership
+    stmt_doc = (
+        sa.select(models.Document)
+        .where(models.Document.id == doc_id)
+        .where(models.Document.owner_id == current_user.id)
+    )
+    result_doc = await db.execute(stmt_doc)
+    if result_doc.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    # 2. Version ของกราฟ: Version ใน Process + Job ล่าสุดใน Postgres (Ingestion อาจรันใน Worker Process อื่น)
+    db_job = await job_queue.get_latest_document_job(db, doc_id)
+    page_key = (cursor, limit, media_type)
+    etag = None
+    if db_job is None or db_job.status in (job_queue.DONE, job_queue.FAILED, job_queue.CANCELLED):
+        job_token = f"{db_job.id}:{db_job.status}:{db_job.updated_at.isoformat()}" if db_job else "none"
+        etag = graph_cache.make_etag(current_user.id, doc_id, content_hash(job_token)[:16], media_type)
+        if graph_cache.etag_matches(if_none_match, etag):
+            return etag, None
+
+        body = graph_cache.get(current_user.id, doc_id, page_key, etag)
+        if body is not None:
+            return etag, body
+
+    # 3. Get graph data from Neo4j (1 หน้า)
+    try:
+        graph_data = await get_document_graph(doc_id, current_user.id, cursor, limit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    body = graph_cache.serialize(graph_data, media_type)
+    if etag is not None:
+        graph_cache.put(current_user.id, doc_id, page_key, etag, body)
+    return etag, body
+
+async def get_document_status(
     doc_id: int,
     db: AsyncSession,
     current_user: models.User
@@ -166,18 +430,42 @@ async def get_graph_data(
     if result_doc.scalar_one_or_none() is None:
         raise HTTPException(status_code=404, detail="Document not found")
 
-    # 2. Get graph data from Neo4j
-    graph_data = await get_document_graph(doc_id, current_user.id)
-    
-    return graph_data
+    # 2. Latest ingestion job (เอกสารเก่าที่ไม่มี Job ถือว่าเสร็จแล้ว)
+    db_job = await job_queue.get_latest_document_job(db, doc_id)
+    if db_job is None:
+        return {"document_id": doc_id, "status": job_queue.DONE}
+
+    return {
+        "document_id": doc_id,
+        "status": db_job.status,
+        "stage": db_job.stage,
+        "attempts": db_job.attempts,
+        "max_attempts": db_job.max_attempts,
+        "last_error": db_job.last_error,
+        "updated_at": db_job.updated_at,
+    }
 
 async def fetch_sec_document(
     ticker: str,
+    db: AsyncSession,
     current_user: models.User
 ):
-    asyncio.create_task(
-        sec_service.fetch_and_process_10k(
-            user_id=current_user.id,
-            ticker=ticker
-        )
+    ticker = ticker.upper()
+
+    # 1. Create Document record ก่อน เพื่อให้ติดตามสถานะได้ทันที
+    db_doc = await crud.create_document(
+        db=db,
+        filename=f"{ticker}_10K_Report.txt",
+        owner_id=current_user.id
     )
+
+    # 2. Queue download + processing
+    await job_queue.enqueue_job(
+        db=db,
+        kind="ingest_sec",
+        user_id=current_user.id,
+        document_id=db_doc.id,
+        payload={"ticker": ticker}
+    )
+
+    return db_doc
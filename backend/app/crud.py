@@ -73,4 +73,55 @@ async def delete_document(db: AsyncSession, document_id: int):
     stmt = sa.delete(models.Document).where(models.Document.id == document_id)
     await db.execute(stmt)
     await db.commit()
-    return
\ No newline at end of file
+    return
+
+# "R" - Dedup Lookups
+async def get_reusable_document(
+    db: AsyncSession,
+    content_hash: str,
+    exclude_document_id: int,
+    owner_id: int
+) -> models.Document | None:
+    """
+    หาเอกสารอื่นที่มีไฟล์เหมือนกัน (content_hash) ประมวลผลเสร็จแล้ว และกราฟครบ (graph_complete)
+    (เอกสารของ User เดียวกันมาก่อน)
+    """
+    finished = (
+        sa.exists()
+        .where(models.Job.document_id == models.Document.id)
+        .where(models.Job.status == "done")
+    )
+    stmt = (
+        select(models.Document)
+        .where(models.Document.content_hash == content_hash)
+        .where(models.Document.id != exclude_document_id)
+        .where(finished)
+        .where(models.Document.graph_complete.is_(True))
+        .order_by((models.Document.owner_id == owner_id).desc(), models.Document.id.desc())
+        .limit(1)
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+async def mark_graph_complete(db: AsyncSession, document_id: int):
+    await db.execute(
+        sa.update(models.Document)
+        .where(models.Document.id == document_id)
+        .values(graph_complete=True)
+    )
+    await db.commit()
+
+async def get_embeddings_by_hash(db: AsyncSession, hashes: list[str]) -> dict:
+    """
+    คืนค่า {content_hash: embedding} ของ Chunks ที่เคย Embed ไปแล้ว
+    """
+    if not hashes:
+        return {}
+    stmt = (
+        select(models.Chunk.content_hash, models.Chunk.embedding)
+        .where(models.Chunk.content_hash.in_(set(hashes)))
+        .where(models.Chunk.embedding.is_not(None))
+        .distinct(models.Chunk.content_hash)
+    )
+    result = await db.execute(stmt)
+    return {row.content_hash: row.embedding for row in result}
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import re
+import sys
+from array import array
+from collections import deque
+from itertools import chain
+from app.cache import LRUCache
+from app.config import settings
+
+log = logging.getLogger("uvicorn.error")
+
+
+# คำ = ตัวอักษร/ตัวเลขติดกัน หรือเครื่องหมาย 1 ตัว ("_" เป็นตัวคั่น -> "Jensen_Huang" = "jensen huang")
+_TOKEN_PATTERN = re.compile(r"[^\W_]+|[^\w\s]")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton ระดับ "คำ": หา Pattern ทั้งหมดในข้อความด้วยการสแกนรอบเดียว O(words + matches)
+    - จำนวน State ~ จำนวนคำใน Pattern (ไม่ใช่จำนวนตัวอักษร) และ Transition อยู่ใน Dict เดียว -> กิน Memory น้อย
+    - Match ตรงขอบคำเสมอ
+    เพิ่ม Pattern ได้ตลอด -- Failure links จะถูกสร้างใหม่ตอน search ครั้งถัดไป (เฉพาะเมื่อมีของใหม่)
+    """
+    def __init__(self):
+        self._goto: dict[tuple[int, str], int] = {}
+        self._fail = array("l", [0])
+        self._output: dict[int, list[tuple[int, str]]] = {}
+        self._state_count = 1
+        self._dirty = False
+
+    def add(self, words: list[str], value: str) -> bool:
+        """คืนค่า True ถ้าเป็น Pattern ใหม่"""
+        state = 0
+        for word in words:
+            word = sys.intern(word)
+            next_state = self._goto.get((state, word))
+            if next_state is None:
+                next_state = self._state_count
+                self._state_count += 1
+                self._goto[(state, word)] = next_state
+            state = next_state
+        outputs = self._output.setdefault(state, [])
+        if any(existing == value for _, existing in outputs):
+            return False
+        outputs.append((len(words), value))
+        self._dirty = True
+        return True
+
+    def _build(self):
+        # BFS สร้าง Failure links; output ของแต่ละ state เก็บเฉพาะของตัวเอง แล้วไล่ตาม fail ตอน search
+        children: dict[int, list[tuple[str, int]]] = {}
+        for (state, word), next_state in self._goto.items():
+            children.setdefault(state, []).append((word, next_state))
+
+        self._fail = array("l", [0]) * self._state_count
+        queue = deque(next_state for _, next_state in children.get(0, []))
+        while queue:
+            state = queue.popleft()
+            for word, next_state in children.get(state, []):
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and (fallback, word) not in self._goto:
+                    fallback = self._fail[fallback]
+                candidate = self._goto.get((fallback, word), 0)
+                self._fail[next_state] = candidate if candidate != next_state else 0
+        self._dirty = False
+
+    def build(self):
+        """สร้าง Failure links ล่วงหน้า (เรียกใน Thread ก่อนนำ Automaton ใหญ่มาใช้)"""
+        if self._dirty:
+            self._build()
+
+    def contains(self, words: list[str], value: str) -> bool:
+        state = 0
+        for word in words:
+            state = self._goto.get((state, word))
+            if state is None:
+                return False
+        return any(existing == value for _, existing in self._output.get(state, ()))
+
+    def values(self):
+        for outputs in self._output.values():
+            for _, value in outputs:
+                yield value
+
+    def search(self, words: list[str]):
+        """yield (start, end, value) เป็นตำแหน่งคำ ของทุก Pattern ที่เจอ"""
+        if self._dirty:
+            self._build()
+        state = 0
+        for i, word in enumerate(words):
+            while state and (state, word) not in self._goto:
+                state = self._fail[state]
+            state = self._goto.get((state, word), 0)
+            match_state = state
+            while match_state:
+                for length, value in self._output.get(match_state, ()):
+                    yield i - length + 1, i + 1, value
+                match_state = self._fail[match_state]
+
+
+def _build_automaton(entity_ids) -> tuple[AhoCorasick, int]:
+    """(รันใน Thread) สร้าง Automaton พร้อม Failure links จากชื่อทั้งหมด -- คืนค่า (automaton, จำนวนชื่อ)"""
+    automaton = AhoCorasick()
+    count = 0
+    for entity_id in entity_ids:
+        words = _alias_words(entity_id)
+        if words and automaton.add(words, entity_id):
+            count += 1
+    automaton.build()
+    return automaton, count
+
+
+def _alias_words(entity_id: str) -> list[str] | None:
+    if not entity_id:
+        return None
+    words = tokenize(entity_id)
+    if sum(len(word) for word in words) < settings.ENTITY_MATCHER_MIN_ALIAS_LENGTH:
+        return None
+    return words
+
+
+class EntityMatcher:
+    """
+    Dictionary ของ Entity ใน Graph ของ User หนึ่งคน (id -> คำ, "_" ถือเป็นช่องว่าง)
+    หา Entity ในคำถามได้ทันทีโดยไม่ต้องเรียก LLM
+    ชื่อที่สั้นกว่า ENTITY_MATCHER_MIN_ALIAS_LENGTH (เช่น "AI", "IT") ไม่ถูกใส่ -- ชนกับคำทั่วไปในคำถาม
+
+    แบ่งเป็น 2 ชั้น เพื่อไม่ต้องสร้าง Failure links ของทั้ง Dictionary บน Event Loop:
+    - base: Automaton ใหญ่ที่สร้างเสร็จแล้วใน Thread (อ่านอย่างเดียว -- ถูกสลับทั้งก้อนเมื่อสร้างใหม่)
+    - pending: ชื่อใหม่จาก store_graph_data เก็บเป็น Dict (tuple ของคำ -> ids) หาแบบ n-gram ไม่ต้องสร้างอะไรเลย
+      ครบ ENTITY_MATCHER_PENDING_MAX ชื่อ -> รวมเข้า base ใน Thread (ดู compact)
+    """
+    def __init__(self, base: AhoCorasick | None = None, size: int = 0):
+        self._base = base or AhoCorasick()
+        self._pending: dict[tuple[str, ...], list[str]] = {}
+        self._pending_ids: list[str] = []
+        self._pending_max_words = 0
+        self._captured: list[str] | None = None
+        self.size = size
+        self.stale = False      # Entity ถูกลบ/คัดลอก -> ควรโหลดใหม่จาก Neo4j (ใช้ตัวเดิมไปก่อน)
+        self.rebuilding = False
+
+    def add(self, entity_ids) -> int:
+        added = 0
+        for entity_id in entity_ids:
+            words = _alias_words(entity_id)
+            if not words or self._base.contains(words, entity_id):
+                continue
+            key = tuple(words)
+            values = self._pending.setdefault(key, [])
+            if entity_id not in values:
+                values.append(entity_id)
+                self._pending_ids.append(entity_id)
+                self._pending_max_words = max(self._pending_max_words, len(key))
+                if self._captured is not None:
+                    self._captured.append(entity_id)
+                added += 1
+        self.size += added
+        return added
+
+    @property
+    def needs_compaction(self) -> bool:
+        return len(self._pending_ids) >= settings.ENTITY_MATCHER_PENDING_MAX
+
+    def capture(self):
+        """เริ่มจดชื่อที่ถูก add ระหว่างสร้าง Matcher ตัวใหม่ใน Thread (จะได้ไม่หายตอนสลับ)"""
+        self._captured = []
+
+    def end_capture(self) -> list[str]:
+        captured, self._captured = self._captured or [], None
+        return captured
+
+    async def compact(self):
+        """รวม pending เข้า base: สร้าง Automaton ใหม่ใน Thread แล้วสลับ (ระหว่างนั้น search ใช้ตัวเดิม)"""
+        merged = len(self._pending_ids)
+        # base ไม่ถูกแก้หลังสร้างเสร็จ -> อ่านจาก Thread ได้
+        names = chain(self._base.values(), self._pending_ids[:merged])
+        base, size = await asyncio.to_thread(_build_automaton, names)
+        remaining = self._pending_ids[merged:]
+        self._base, self._pending, self._pending_ids, self._pending_max_words = base, {}, [], 0
+        self.size = size
+        self.add(remaining)
+
+    def find(self, text: str, limit: int | None = None) -> list[str]:
+        """
+        คืนค่า Entity ids ที่ปรากฏในข้อความ -- ชื่อยาวกว่าได้ก่อน และไม่ทับกัน
+        """
+        words = tokenize(text)
+        candidates = list(self._base.search(words))
+        for start in range(len(words) if self._pending else 0):
+            for end in range(start + 1, min(len(words), start + self._pending_max_words) + 1):
+                for value in self._pending.get(tuple(words[start:end]), ()):
+                    candidates.append((start, end, value))
+        candidates.sort(key=lambda match: (-(match[1] - match[0]), match[0]))
+
+        taken = [False] * len(words)
+        found = []
+        for start, end, value in candidates:
+            if any(taken[start:end]) or value in found:
+                continue
+            taken[start:end] = [True] * (end - start)
+            found.append(value)
+            if limit and len(found) >= limit:
+                break
+        return found
+
+
+async def build_matcher(entity_ids: list[str]) -> EntityMatcher:
+    """สร้าง Matcher ของทั้ง Dictionary ใน Thread (ไม่บล็อก Event Loop)"""
+    base, size = await asyncio.to_thread(_build_automaton, entity_ids)
+    return EntityMatcher(base, size)
+
+
+# Matcher ต่อ User (โหลดจาก Neo4j ครั้งแรกที่ใช้ -- ดู knowledge_graph.get_entity_matcher)
+# จำกัดด้วยจำนวนชื่อรวมของทุก User (ไม่ใช่จำนวน User) -- User ที่มีกราฟใหญ่กินโควตามากกว่า
+_matchers = LRUCache(
+    settings.ENTITY_MATCHER_MAX_PATTERNS, name="entity_matcher", weigh=lambda matcher: matcher.size
+)
+
+
+def get(user_id: int) -> EntityMatcher | None:
+    return _matchers.get(user_id)
+
+
+def put(user_id: int, matcher: EntityMatcher):
+    _matchers.put(user_id, matcher)
+
+
+# Task เบื้องหลัง (compact) -- เก็บ Reference ไว้ไม่ให้ถูก GC ระหว่างรัน
+_background: set[asyncio.Task] = set()
+
+
+async def _compact(user_id: int, matcher: EntityMatcher):
+    matcher.rebuilding = True
+    try:
+        await matcher.compact()
+        if _matchers.peek(user_id) is matcher:
+            _matchers.put(user_id, matcher)
+    except Exception as e:
+        log.error(f"Entity dictionary compaction failed for user {user_id}: {e}")
+    finally:
+        matcher.rebuilding = False
+
+
+def add_entities(user_id: int, entity_ids) -> int:
+    """
+    เพิ่ม Entity ใหม่เข้า Matcher ที่โหลดอยู่แล้ว (ถ้ายังไม่โหลด รอบหน้าจะโหลดจาก Neo4j ครบเอง)
+    """
+    matcher = _matchers.peek(user_id)
+    if matcher is None:
+        return 0
+    added = matcher.add(entity_ids)
+    if added:
+        # ขนาดเปลี่ยน -> put ใหม่เพื่อคำนวณโควตาและ Evict User อื่นถ้าเกิน
+        _matchers.put(user_id, matcher)
+        if matcher.needs_compaction and not matcher.rebuilding:
+            task = asyncio.get_running_loop().create_task(_compact(user_id, matcher))
+            _background.add(task)
+            task.add_done_callback(_background.discard)
+    return added
+
+
+def invalidate(user_id: int):
+    """ทำเครื่องหมายให้โหลดใหม่ (knowledge_graph.get_entity_matcher โหลดเบื้องหลัง และใช้ตัวเดิมไปก่อน)"""
+    matcher = _matchers.peek(user_id)
+    if matcher is not None:
+        matcher.stale = True
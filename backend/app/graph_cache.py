@@ -0,0 +1,126 @@
+import json
+import logging
+import uuid
+from collections import OrderedDict
+import msgpack
+from app.cache import LRUCache
+from app.config import settings
+
+log = logging.getLogger("uvicorn.error")
+
+# Cache ของ GET /documents/{id}/graph (Body ที่ Serialize แล้ว: JSON หรือ MessagePack) + ETag
+# - Version ต่อ User (ไม่ใช่ต่อเอกสาร): Entity ถูกแชร์ข้ามเอกสารของ User เดียวกัน
+#   Ingest เอกสารอื่นแก้ label/type ของ Node ที่เอกสารนี้ใช้ได้ -> store/copy/delete ไหนก็ตามของ User ทำให้ ETag ทุกเอกสารเปลี่ยน
+# - Version มาจากนาฬิกาเดียวที่เพิ่มขึ้นเรื่อยๆ และเก็บแค่ GRAPH_CACHE_MAX_VERSIONS User ล่าสุด
+#   User ที่ถูก Evict จะอ่านได้ _floor (ค่านาฬิกาตอน Evict) ซึ่งมากกว่า Version ใดๆ ที่เคยแจกไป -> ไม่ชน ETag เก่า
+# - BOOT_ID: Version อยู่ใน Memory -> Restart แล้วต้องไม่ชนกับ ETag เดิมที่ Browser ถืออยู่
+BOOT_ID = uuid.uuid4().hex[:8]
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/x-msgpack"
+COMPACT_FORMAT_VERSION = "graph-compact-v1"
+
+_versions: OrderedDict[int, int] = OrderedDict()
+_clock = 0
+_floor = 0
+_pages = LRUCache(settings.GRAPH_CACHE_MAX_PAGES, name="graph_cache")
+
+
+def bump(user_id: int):
+    global _clock, _floor
+    _clock += 1
+    _versions[user_id] = _clock
+    _versions.move_to_end(user_id)
+    while len(_versions) > max(1, settings.GRAPH_CACHE_MAX_VERSIONS):
+        _versions.popitem(last=False)
+        _floor = _clock
+
+
+def make_etag(user_id: int, doc_id: int, state_token: str, media_type: str = JSON_MEDIA_TYPE) -> str:
+    """
+    state_token = สถานะที่มาจากภายนอก Process (เช่น Job ล่าสุดใน Postgres) เพื่อให้ทุก Worker เห็นตรงกัน
+    แต่ละ Representation (JSON / MessagePack) ต้องได้ ETag ต่างกัน
+    """
+    suffix = "-mp" if media_type == MSGPACK_MEDIA_TYPE else ""
+    version = _versions.get(user_id, _floor)
+    return f'"{BOOT_ID}-{doc_id}-{version}-{state_token}{suffix}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def get(user_id: int, doc_id: int, page_key: tuple, etag: str) -> bytes | None:
+    entry = _pages.get((user_id, doc_id, page_key))
+    if entry is None or entry[0] != etag:
+        return None
+    return entry[1]
+
+
+def put(user_id: int, doc_id: int, page_key: tuple, etag: str, body: bytes):
+    _pages.put((user_id, doc_id, page_key), (etag, body))
+
+
+# --- Representations (Content Negotiation ผ่าน Accept header) ---
+
+
+def negotiate_media_type(accept: str | None) -> str:
+    if accept and ("application/x-msgpack" in accept or "application/msgpack" in accept):
+        return MSGPACK_MEDIA_TYPE
+    return JSON_MEDIA_TYPE
+
+
+def to_compact(graph_data: dict) -> dict:
+    """
+    แปลง GraphData เป็นแบบ Columnar:
+    - nodes: id/label แยกเป็น Array, type เป็น Index เข้า "types"
+    - edges: source/target เป็น Index เข้า nodes, relation เป็น Index เข้า "relations"
+    ชื่อ Entity และ Relation แต่ละตัวถูกส่งแค่ครั้งเดียว ไม่ซ้ำทุก Edge
+    """
+    node_index: dict[str, int] = {}
+    node_ids, node_labels, node_types = [], [], []
+    types: dict[str, int] = {}
+    relations: dict[str, int] = {}
+
+    def intern(value: str, table: dict[str, int]) -> int:
+        if value not in table:
+            table[value] = len(table)
+        return table[value]
+
+    def add_node(node_id: str, label: str, node_type: str) -> int:
+        node_index[node_id] = len(node_ids)
+        node_ids.append(node_id)
+        node_labels.append(label)
+        node_types.append(intern(node_type, types))
+        return node_index[node_id]
+
+    for node in graph_data["nodes"]:
+        if node["id"] not in node_index:
+            add_node(node["id"], node["label"], node["type"])
+
+    sources, targets, edge_relations = [], [], []
+    for edge in graph_data["edges"]:
+        for column, node_id in ((sources, edge["source"]), (targets, edge["target"])):
+            index = node_index.get(node_id)
+            if index is None:
+                index = add_node(node_id, node_id, "Unknown")
+            column.append(index)
+        edge_relations.append(intern(edge["relation"], relations))
+
+    return {
+        "format": COMPACT_FORMAT_VERSION,
+        "types": list(types),
+        "relations": list(relations),
+        "nodes": {"id": node_ids, "label": node_labels, "type": node_types},
+        "edges": {"source": sources, "target": targets, "relation": edge_relations},
+        "next_cursor": graph_data.get("next_cursor"),
+    }
+
+
+def serialize(graph_data: dict, media_type: str = JSON_MEDIA_TYPE) -> bytes:
+    if media_type == MSGPACK_MEDIA_TYPE:
+        return msgpack.packb(to_compact(graph_data), use_bin_type=True)
+    return json.dumps(graph_data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
@@ -0,0 +1,298 @@
+import asyncio
+import datetime
+import logging
+from typing import Awaitable, Callable
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, processing, sec_service, answer_cache, knowledge_graph
+from app.config import settings
+from app.database import SessionLocal
+
+log = logging.getLogger("uvicorn.error")
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+StageReporter = Callable[[str], Awaitable[None]]
+CancelCheck = Callable[[], Awaitable[None]]
+
+
+class JobCancelled(Exception):
+    """Handler หยุดกลางทาง เพราะเอกสารของงานถูกลบไปแล้ว"""
+
+_workers: list[asyncio.Task] = []
+_wakeup = asyncio.Event()
+
+
+# --- Enqueue / Inspect (ใช้จาก Controller) ---
+
+async def enqueue_job(
+    db: AsyncSession,
+    kind: str,
+    user_id: int,
+    document_id: int | None = None,
+    payload: dict | None = None,
+    content: bytes | None = None
+) -> models.Job:
+    """
+    บันทึกงานลงตาราง jobs (Commit ทันที) แล้วปลุก Worker ให้มาหยิบไปทำ
+    """
+    db_job = models.Job(
+        kind=kind,
+        status=QUEUED,
+        user_id=user_id,
+        document_id=document_id,
+        payload=payload or {},
+        content=content,
+        max_attempts=settings.INGESTION_MAX_ATTEMPTS,
+    )
+    db.add(db_job)
+    await db.commit()
+    await db.refresh(db_job)
+
+    _wakeup.set()
+    log.info(f"📥 Job {db_job.id} ({kind}) queued for Doc ID: {document_id}")
+    return db_job
+
+
+async def get_latest_document_job(db: AsyncSession, document_id: int) -> models.Job | None:
+    stmt = (
+        sa.select(models.Job)
+        .where(models.Job.document_id == document_id)
+        .order_by(models.Job.id.desc())
+        .limit(1)
+    )
+    result = await db.execute(stmt)
+    return result.scalar_one_or_none()
+
+
+async def cancel_document_jobs(db: AsyncSession, document_id: int):
+    """
+    ยกเลิกงานที่ยังไม่ได้เริ่มของเอกสารนี้ (เช่น ตอนผู้ใช้ลบเอกสาร)
+    """
+    stmt = (
+        sa.update(models.Job)
+        .where(models.Job.document_id == document_id)
+        .where(models.Job.status == QUEUED)
+        .where(models.Job.kind.notin_(CLEANUP_JOB_KINDS))
+        .values(status=CANCELLED, updated_at=datetime.datetime.utcnow())
+    )
+    await db.execute(stmt)
+    await db.commit()
+
+
+# --- Job Handlers ---
+
+async def _handle_ingest_upload(job: models.Job, report_stage: StageReporter, check_cancelled: CancelCheck):
+    await processing.save_extract_chunk_and_embed(
+        document_id=job.document_id,
+        user_id=job.user_id,
+        filename=job.payload["filename"],
+        content_type=job.payload["content_type"],
+        content=job.content,
+        report_stage=report_stage,
+        check_cancelled=check_cancelled
+    )
+
+async def _handle_ingest_sec(job: models.Job, report_stage: StageReporter, check_cancelled: CancelCheck):
+    await sec_service.fetch_and_process_10k(
+        user_id=job.user_id,
+        ticker=job.payload["ticker"],
+        document_id=job.document_id,
+        report_stage=report_stage,
+        check_cancelled=check_cancelled
+    )
+
+async def _handle_graph_cleanup(job: models.Job, report_stage: StageReporter, check_cancelled: CancelCheck):
+    await knowledge_graph.delete_document_graph(job.document_id, job.user_id)
+
+JOB_HANDLERS: dict[str, Callable[[models.Job, StageReporter, CancelCheck], Awaitable[None]]] = {
+    "ingest_upload": _handle_ingest_upload,
+    "ingest_sec": _handle_ingest_sec,
+    "graph_cleanup": _handle_graph_cleanup,
+}
+
+# งานที่ต้องทำต่อแม้เอกสารถูกลบไปแล้ว (ไม่ Cancel อัตโนมัติ)
+CLEANUP_JOB_KINDS = {"graph_cleanup"}
+
+
+# --- Worker Internals ---
+
+async def _claim_next_job() -> models.Job | None:
+    """
+    หยิบงานถัดไปแบบ Atomic (FOR UPDATE SKIP LOCKED) เพื่อไม่ให้ Worker สองตัวได้งานเดียวกัน
+    """
+    now = datetime.datetime.utcnow()
+    async with SessionLocal() as db:
+        stmt = (
+            sa.select(models.Job)
+            .where(models.Job.status == QUEUED)
+            .where(models.Job.run_after <= now)
+            .order_by(models.Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        result = await db.execute(stmt)
+        job = result.scalar_one_or_none()
+        if job is None:
+            return None
+
+        job.status = RUNNING
+        job.stage = None
+        job.attempts += 1
+        job.updated_at = now
+        await db.commit()
+        return job
+
+
+async def _update_job(job_id: int, **values):
+    values["updated_at"] = datetime.datetime.utcnow()
+    async with SessionLocal() as db:
+        await db.execute(
+            sa.update(models.Job).where(models.Job.id == job_id).values(**values)
+        )
+        await db.commit()
+
+
+async def _document_exists(document_id: int) -> bool:
+    async with SessionLocal() as db:
+        result = await db.execute(
+            sa.select(models.Document.id).where(models.Document.id == document_id)
+        )
+        return result.scalar_one_or_none() is not None
+
+
+async def _requeue_graph_cleanup(job: models.Job):
+    """
+    เอกสารถูกลบระหว่างที่งานนี้รันอยู่ -> graph_cleanup ตอนลบอาจรันไปก่อนที่งานนี้จะเขียน Graph เสร็จ
+    เข้าคิว graph_cleanup อีกรอบหลังงานนี้จบ (ลบซ้ำได้ ไม่มีผลเสีย)
+    """
+    if job.kind in CLEANUP_JOB_KINDS or job.document_id is None:
+        return
+    if await _document_exists(job.document_id):
+        return
+    async with SessionLocal() as db:
+        await enqueue_job(db=db, kind="graph_cleanup", user_id=job.user_id, document_id=job.document_id)
+
+
+async def _run_job(job: models.Job):
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        await _update_job(job.id, status=FAILED, last_error=f"Unknown job kind: {job.kind}")
+        return
+
+    if (
+        job.kind not in CLEANUP_JOB_KINDS
+        and job.document_id is not None
+        and not await _document_exists(job.document_id)
+    ):
+        log.info(f"🗑️ Job {job.id} cancelled (Doc ID: {job.document_id} was deleted)")
+        await _update_job(job.id, status=CANCELLED)
+        return
+
+    async def check_cancelled():
+        # Handler เรียกระหว่างขั้นตอน และก่อนเขียน Graph แต่ละครั้ง (cancel_document_jobs ยกเลิกได้แค่งาน queued)
+        if (
+            job.kind not in CLEANUP_JOB_KINDS
+            and job.document_id is not None
+            and not await _document_exists(job.document_id)
+        ):
+            raise JobCancelled(f"Doc ID: {job.document_id} was deleted")
+
+    async def report_stage(stage: str):
+        await check_cancelled()
+        log.info(f"⚙️ Job {job.id} stage -> {stage}")
+        await _update_job(job.id, stage=stage)
+
+    log.info(f"▶️ Job {job.id} ({job.kind}) started, attempt {job.attempts}/{job.max_attempts}")
+    try:
+        await handler(job, report_stage, check_cancelled)
+    except JobCancelled as e:
+        log.info(f"🗑️ Job {job.id} stopped ({e})")
+        await _update_job(job.id, status=CANCELLED, stage=None, content=None)
+        await _requeue_graph_cleanup(job)
+        return
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if job.attempts < job.max_attempts:
+            delay = settings.INGESTION_RETRY_BACKOFF_SECONDS * (2 ** (job.attempts - 1))
+            log.warning(f"🔁 Job {job.id} failed ({error}). Retrying in {delay:.0f}s")
+            await _update_job(
+                job.id,
+                status=QUEUED,
+                last_error=error,
+                run_after=datetime.datetime.utcnow() + datetime.timedelta(seconds=delay),
+            )
+        else:
+            log.error(f"❌ Job {job.id} failed permanently: {error}")
+            await _update_job(job.id, status=FAILED, last_error=error)
+            await _requeue_graph_cleanup(job)
+        return
+
+    # Content ไม่จำเป็นแล้วหลังจากทำเสร็จ -> ลบทิ้งเพื่อไม่ให้ตารางบวม
+    await _update_job(job.id, status=DONE, stage=None, last_error=None, content=None)
+    # Chunks/Graph ใหม่พร้อมใช้แล้ว -> คำตอบที่ Cache ไว้ของ User นี้ล้าสมัย
+    answer_cache.bump_corpus_version(job.user_id)
+    log.info(f"✅ Job {job.id} done")
+    await _requeue_graph_cleanup(job)
+
+
+async def _worker_loop(worker_id: int):
+    while True:
+        try:
+            _wakeup.clear()
+            job = await _claim_next_job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.error(f"Worker {worker_id} could not claim job: {e}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=settings.INGESTION_POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        try:
+            await _run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # เช่น DB หลุดตอนอัปเดตสถานะ -- Worker ต้องไม่ตาย (งานนี้จะค้าง running จนกว่า start_workers รอบหน้า)
+            log.error(f"Worker {worker_id} failed while running job {job.id}: {e}")
+
+
+# --- Life Cycle (เรียกจาก main.lifespan) ---
+
+async def start_workers():
+    """
+    คืนงานที่ค้างสถานะ running (จาก process ก่อนหน้าที่ตายไป) กลับเข้าคิว แล้วเริ่ม Worker Pool
+    หมายเหตุ: สมมติว่ามี API process เดียวที่รัน Worker
+    """
+    async with SessionLocal() as db:
+        result = await db.execute(
+            sa.update(models.Job)
+            .where(models.Job.status == RUNNING)
+            .values(status=QUEUED, updated_at=datetime.datetime.utcnow())
+        )
+        await db.commit()
+        if result.rowcount:
+            log.info(f"♻️ Re-queued {result.rowcount} interrupted job(s)")
+
+    for i in range(settings.INGESTION_WORKERS):
+        _workers.append(asyncio.create_task(_worker_loop(i)))
+    log.info(f"👷 Started {settings.INGESTION_WORKERS} ingestion worker(s)")
+
+
+async def stop_workers():
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    log.info("Ingestion workers stopped.")
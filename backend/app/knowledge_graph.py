@@ -1,11 +1,17 @@
+import asyncio
+import base64
+import binascii
 import json
 import logging
 import re
+from itertools import zip_longest
 from neo4j import AsyncGraphDatabase
 from neo4j.exceptions import ServiceUnavailable
 from app.config import settings
-from litellm import acompletion
-from tenacity import retry, stop_after_attempt, wait_exponential
+from app import llm_limiter, llm_cache, metrics, entity_matcher, graph_cache
+from app.utils import estimate_tokens
+from litellm import acompletion, RateLimitError
+from tenacity import retry, retry_if_not_exception_type, stop_after_attempt, wait_exponential
 
 # Logger & Driver Setup
 log = logging.getLogger("uvicorn.error")
@@ -69,6 +75,103 @@ async def check_neo4j_connection():
         log.error(f"Error checking Neo4j connection: {e}")
         return False
 
+# --- Schema Bootstrap (Constraints & Indexes) ---
+# ทุกคำสั่งเป็น IF NOT EXISTS -> รันซ้ำได้ทุกครั้งที่ App Start
+GRAPH_SCHEMA = {
+    # MERGE/MATCH (n:Entity {id, user_id}) -> Index Seek แทน Label Scan
+    "entity_id_user_unique":
+        "CREATE CONSTRAINT entity_id_user_unique IF NOT EXISTS "
+        "FOR (n:Entity) REQUIRE (n.id, n.user_id) IS UNIQUE",
+    # MATCH (n:Entity {user_id}) (Fallback Graph, Orphan Cleanup)
+    "entity_user_id":
+        "CREATE INDEX entity_user_id IF NOT EXISTS FOR (n:Entity) ON (n.user_id)",
+    # MATCH ()-[r:RELATION {doc_id, user_id}]->() (Document Graph, Delete)
+    "relation_doc_user":
+        "CREATE INDEX relation_doc_user IF NOT EXISTS FOR ()-[r:RELATION]-() ON (r.doc_id, r.user_id)",
+    # Graph API: Keyset Pagination ด้วย r.seq (Index Seek + เรียงตาม Index ไม่ต้อง Sort ทุก Edge ของเอกสาร)
+    "relation_doc_user_seq":
+        "CREATE INDEX relation_doc_user_seq IF NOT EXISTS FOR ()-[r:RELATION]-() ON (r.doc_id, r.user_id, r.seq)",
+    # MATCH ()-[r:RELATION {user_id}]-() (Global GraphRAG)
+    "relation_user_id":
+        "CREATE INDEX relation_user_id IF NOT EXISTS FOR ()-[r:RELATION]-() ON (r.user_id)",
+    # db.index.fulltext.queryNodes (GraphRAG: หา Entity จากคำค้นของ LLM)
+    "entity_name_fulltext":
+        "CREATE FULLTEXT INDEX entity_name_fulltext IF NOT EXISTS FOR (n:Entity) ON EACH [n.id, n.name]",
+}
+
+SEQ_MIGRATION = "relation_seq"
+
+
+async def _backfill_relation_seq(session):
+    """
+    (ครั้งเดียว) ใส่ seq ให้ Edge จากเวอร์ชันก่อนที่ยังไม่มี -- ทำเสร็จแล้วสร้าง Node :GraphMigration ไว้ Startup ครั้งถัดไปข้ามเลย
+    ค่าติดลบไล่ลงจาก seq ต่ำสุดที่มีอยู่ (ไม่ซ้ำกัน และเรียงก่อน Edge ใหม่) -- แต่ละ Batch Commit แยกกัน ถ้าหยุดกลางทางทำต่อได้
+    """
+    result = await session.run("MATCH (m:GraphMigration {name: $name}) RETURN m LIMIT 1", name=SEQ_MIGRATION)
+    if await result.single() is not None:
+        return
+
+    result = await session.run("MATCH ()-[r:RELATION]->() RETURN min(r.seq) AS low")
+    record = await result.single()
+    next_seq = min(0, record["low"] or 0) - 1
+    backfilled = 0
+    while True:
+        result = await session.run("""
+            MATCH ()-[r:RELATION]->()
+            WHERE r.seq IS NULL
+            WITH r LIMIT $batch_size
+            WITH collect(r) AS rels
+            UNWIND range(0, size(rels) - 1) AS i
+            WITH rels[i] AS r, i
+            SET r.seq = $next_seq - i
+            RETURN count(*) AS updated
+        """, batch_size=settings.GRAPH_DELETE_BATCH_SIZE, next_seq=next_seq)
+        record = await result.single()
+        updated = record["updated"] if record else 0
+        if not updated:
+            break
+        next_seq -= updated
+        backfilled += updated
+
+    await (await session.run("MERGE (:GraphMigration {name: $name})", name=SEQ_MIGRATION)).consume()
+    if backfilled:
+        log.info(f"🔢 Backfilled seq on {backfilled} graph edges")
+
+
+async def ensure_graph_schema():
+    """Creates the constraints/indexes in GRAPH_SCHEMA (idempotent)."""
+    async with driver.session() as session:
+        for name, statement in GRAPH_SCHEMA.items():
+            try:
+                # consume() ให้ Error ของคำสั่งนี้โผล่ตรงนี้ (ไม่ไปโผล่ตอน run คำสั่งถัดไป)
+                await (await session.run(statement)).consume()
+            except Exception as e:
+                # เช่น มี Entity ซ้ำอยู่แล้ว ทำให้สร้าง Unique Constraint ไม่ได้
+                log.error(f"❌ Could not create graph schema '{name}': {e}")
+        try:
+            await _backfill_relation_seq(session)
+        except Exception as e:
+            log.error(f"❌ Could not backfill graph edge seq: {e}")
+        try:
+            # Index ใหม่จะอยู่สถานะ POPULATING สักพัก -> รอให้ ONLINE ก่อนเช็ก
+            await (await session.run("CALL db.awaitIndexes($timeout)", timeout=60)).consume()
+        except Exception as e:
+            log.warning(f"Timed out waiting for graph indexes: {e}")
+
+async def check_graph_schema() -> list[str]:
+    """Returns the names in GRAPH_SCHEMA that are missing or not ONLINE."""
+    online = set()
+    try:
+        async with driver.session() as session:
+            result = await session.run("SHOW INDEXES YIELD name, state")
+            async for record in result:
+                if record["state"] == "ONLINE":
+                    online.add(record["name"])
+    except Exception as e:
+        log.error(f"Error checking graph schema: {e}")
+    # Constraint จะมี Index ชื่อเดียวกันกำกับอยู่
+    return [name for name in GRAPH_SCHEMA if name not in online]
+
 async def close_neo4j_driver():
     """Closes the Neo4j driver connection."""
     await driver.close()
@@ -77,8 +180,77 @@ async def close_neo4j_driver():
 
 # --- Core Logic: AI Extraction (Updated: No filename) ---
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=60))
-async def extract_graph_from_text(text_chunk: str) -> dict:
+GRAPH_EXTRACTION_MODEL = f"{settings.LLM_PROVIDER}/llama-3.1-8b-instant"
+# เปลี่ยนเลขนี้ทุกครั้งที่แก้ Prompt/Validation -> Cache เก่าจะไม่ถูกใช้
+GRAPH_PROMPT_VERSION = "graph-v1"
+# ผลแบบ Packed แยก Key ของตัวเอง (Prompt และ Context ที่ LLM เห็นต่างจากแบบ Chunk เดียว)
+GRAPH_PACKED_PROMPT_VERSION = "graph-packed-v1"
+
+async def _rate_limited_completion(messages: list[dict], max_output_tokens: int | None = None, **kwargs):
+    """
+    เรียก LLM ผ่าน Token Bucket ของ Provider (Requests/min + Tokens/min)
+    ถ้าโดน 429 จะหยุดทั้ง Bucket ตาม Retry-After แล้วลองใหม่
+    """
+    limiter = llm_limiter.get_limiter()
+    max_output_tokens = max_output_tokens or settings.GRAPH_EXTRACTION_MAX_OUTPUT_TOKENS
+    estimated = sum(estimate_tokens(m["content"]) for m in messages) + max_output_tokens
+
+    for attempt in range(settings.LLM_RATE_LIMIT_MAX_RETRIES + 1):
+        await limiter.acquire(estimated)
+        try:
+            response = await acompletion(
+                model=GRAPH_EXTRACTION_MODEL,
+                api_key=settings.LLM_API_KEY,
+                messages=messages,
+                max_tokens=max_output_tokens,
+                **kwargs
+            )
+        except RateLimitError as e:
+            if attempt == settings.LLM_RATE_LIMIT_MAX_RETRIES:
+                raise
+            delay = llm_limiter.retry_after_seconds(e) or min(60, 2 ** (attempt + 2))
+            limiter.back_off(delay)
+            continue
+
+        usage = getattr(response, "usage", None)
+        limiter.record_usage(estimated, getattr(usage, "total_tokens", None))
+        return response
+
+
+async def extract_graph_from_text(text_chunk: str, use_cache: bool = True) -> dict | None:
+    """
+    Extracts Nodes and Relationships from text (ผ่าน LLM Response Cache)
+    use_cache=False: ข้ามการอ่าน Cache (ผู้เรียกเช็กมาแล้ว) แต่ยังเขียนผลลง Cache
+    คืนค่า None ถ้า LLM ล้มเหลว (แยกจาก Chunk ที่ไม่มี Entity จริงๆ)
+    """
+    cache_key = llm_cache.make_key(GRAPH_EXTRACTION_MODEL, GRAPH_PROMPT_VERSION, text_chunk)
+    if use_cache:
+        cached = await llm_cache.get(cache_key)
+        if cached is not None:
+            metrics.incr("llm_cache.graph.hit")
+            return cached
+        metrics.incr("llm_cache.graph.miss")
+
+    try:
+        result = await _extract_graph_with_llm(text_chunk)
+    except Exception as e:
+        log.error(f"Graph extraction failed: {e}")
+        return None
+
+    # Cache เฉพาะผลที่สำเร็จ (Error ไม่ Cache เพื่อให้รอบหน้าลองใหม่)
+    await llm_cache.put(cache_key, GRAPH_EXTRACTION_MODEL, result)
+    return result
+
+
+# Error ชั่วคราว (Timeout, 5xx, JSON พัง) -> ลองใหม่แบบ Exponential Backoff
+# 429 ไม่ต้อง Retry ซ้ำตรงนี้ (_rate_limited_completion จัดการร่วมกับ Token Bucket แล้ว)
+@retry(
+    stop=stop_after_attempt(settings.GRAPH_EXTRACTION_MAX_ATTEMPTS),
+    wait=wait_exponential(multiplier=1, min=4, max=60),
+    retry=retry_if_not_exception_type(RateLimitError),
+    reraise=True
+)
+async def _extract_graph_with_llm(text_chunk: str) -> dict:
     """
     Extracts Nodes and Relationships from text using LLM with balanced accuracy and completeness.
     """
@@ -116,65 +288,168 @@ async def extract_graph_from_text(text_chunk: str) -> dict:
     TEXT: {text_chunk}
     """
     
-    try:
-        response = await acompletion(
-            model=f"{settings.LLM_PROVIDER}/llama-3.1-8b-instant",
-            api_key=settings.LLM_API_KEY,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2,  # Balanced between creativity and consistency
-            response_format={"type": "json_object"}
-        )
-        content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
-        
-        data = json.loads(content)
-        
-        # Light validation - only filter obvious errors
-        nodes = data.get('nodes', [])
-        edges = data.get('edges', [])
-        
-        # Basic CEO validation only
-        filtered_edges = []
-        ceo_count = {}
+    response = await _rate_limited_completion(
+        messages=[{"role": "user", "content": prompt}],
+        temperature=0.2,  # Balanced between creativity and consistency
+        response_format={"type": "json_object"}
+    )
+    content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+    
+    data = json.loads(content)
+    return _filter_extracted_graph(data)
+
+
+def _filter_extracted_graph(data: dict) -> dict:
+    """
+    Light validation ของผลลัพธ์จาก LLM (ใช้ร่วมกันทั้งแบบ Chunk เดียว และแบบ Packed)
+    """
+    # Light validation - only filter obvious errors
+    nodes = data.get('nodes', [])
+    edges = data.get('edges', [])
+    
+    # Basic CEO validation only
+    filtered_edges = []
+    ceo_count = {}
+    
+    for edge in edges:
+        source = edge.get('source', '').strip()
+        target = edge.get('target', '').strip()
+        relation = edge.get('relation', '')
         
-        for edge in edges:
-            source = edge.get('source', '').strip()
-            target = edge.get('target', '').strip()
-            relation = edge.get('relation', '')
+        if not source or not target:
+            continue
             
-            if not source or not target:
-                continue
-                
-            # Only filter CEO relationships that are obviously wrong
-            if relation == "CEO_OF":
-                source_lower = source.lower()
-                
-                # Prevent one person being CEO of more than 2 companies (allow some flexibility)
-                if source_lower in ceo_count:
-                    ceo_count[source_lower] += 1
-                    if ceo_count[source_lower] > 2:
-                        continue
-                else:
-                    ceo_count[source_lower] = 1
+        # Only filter CEO relationships that are obviously wrong
+        if relation == "CEO_OF":
+            source_lower = source.lower()
             
-            filtered_edges.append(edge)
-        
-        result = {"nodes": nodes, "edges": filtered_edges}
-        return result
+            # Prevent one person being CEO of more than 2 companies (allow some flexibility)
+            if source_lower in ceo_count:
+                ceo_count[source_lower] += 1
+                if ceo_count[source_lower] > 2:
+                    continue
+            else:
+                ceo_count[source_lower] = 1
         
-    except Exception as e:
-        log.error(f"Graph extraction failed: {e}")
-        return {"nodes": [], "edges": []}
+        filtered_edges.append(edge)
+    
+    result = {"nodes": nodes, "edges": filtered_edges}
+    return result
+
+
+def _build_packed_prompt(text_chunks: list[str]) -> str:
+    chunk_texts = "\n\n".join(f"[CHUNK {i}]\n{chunk}" for i, chunk in enumerate(text_chunks))
+    prompt = f"""
+    You are an expert Financial Analyst AI building a comprehensive Knowledge Graph from SEC 10-K documents.
+    
+    Below are {len(text_chunks)} independent text chunks, each starting with a [CHUNK n] marker.
+    Extract entities and relationships from EACH chunk separately, focusing on business relevance and accuracy.
+    
+    RULES:
+    1. Extract: Companies, People, Products, Industries, Technologies, Business Concepts
+    2. Include relationships that are clearly stated or strongly implied in business context
+    3. Focus on the PRIMARY company mentioned, but include competitive landscape
+    4. Use clear entity names (e.g., "NVIDIA" not "NVIDIA Corporation")
+    5. Be conservative with CEO relationships - only extract if explicitly mentioned with title
+    6. Return exactly one entry per chunk, in order, even if it has no entities
+    
+    RELATIONSHIP TYPES:
+    - CEO_OF, FOUNDED, OPERATES_IN, COMPETES_WITH, PARTNERS_WITH, PRODUCES, MANUFACTURES
+    - HAS_SUBSIDIARY, SUPPLIES_TO, LOCATED_IN, SPECIALIZES_IN
+    
+    OUTPUT JSON FORMAT:
+    {{
+        "chunks": [
+            {{
+                "chunk": 0,
+                "nodes": [{{"id": "NVIDIA", "type": "ORG"}}, {{"id": "Jensen Huang", "type": "PERSON"}}],
+                "edges": [{{"source": "Jensen Huang", "target": "NVIDIA", "relation": "CEO_OF"}}]
+            }},
+            {{"chunk": 1, "nodes": [], "edges": []}}
+        ]
+    }}
+    
+    {chunk_texts}
+    """
+    return prompt
+
+
+def _pack_output_tokens(chunk_count: int) -> int:
+    return min(settings.GRAPH_PACK_MAX_OUTPUT_TOKENS, settings.GRAPH_PACK_OUTPUT_TOKENS_PER_CHUNK * chunk_count)
+
+
+async def _extract_graph_packed_with_llm(text_chunks: list[str]) -> list[dict]:
+    """
+    Packed Mode: ส่งหลาย Chunk ใน Request เดียว (คำสั่งยาวๆ ถูกส่งแค่ครั้งเดียว)
+    คืนค่า list ของ {"nodes", "edges"} ตามลำดับ Chunk -- ถ้า Parse ไม่ได้จะ raise
+    """
+    response = await _rate_limited_completion(
+        messages=[{"role": "user", "content": _build_packed_prompt(text_chunks)}],
+        max_output_tokens=_pack_output_tokens(len(text_chunks)),
+        temperature=0.2,
+        response_format={"type": "json_object"}
+    )
+    content = response.choices[0].message.content.replace("```json", "").replace("```", "").strip()
+    data = json.loads(content)
+
+    results = {}
+    for entry in data.get("chunks", []):
+        if isinstance(entry, dict) and isinstance(entry.get("chunk"), int):
+            results[entry["chunk"]] = _filter_extracted_graph(entry)
+
+    missing = [i for i in range(len(text_chunks)) if i not in results]
+    if missing:
+        raise ValueError(f"Packed response missing chunks {missing}")
+    return [results[i] for i in range(len(text_chunks))]
+
+
+def _pack_chunks(indices: list[int], chunks: list[str], request_budget: int) -> list[list[int]]:
+    """
+    จัดกลุ่ม Chunk ตามงบ Token ของ Input (GRAPH_PACK_TOKEN_BUDGET) และจำนวนสูงสุดต่อ Request
+    request_budget: Token ที่ 1 Request จองได้ทั้งหมด (คำสั่ง + Chunks + Output) -- ปกติคือขนาด Bucket ของ Provider
+    ถ้าเกิน Bucket จะถูกจำกัดเหลือความจุ Bucket แล้วต้องรอเติมเต็มทุกครั้ง (Packed จะช้ากว่าทีละ Chunk)
+    """
+    overhead = estimate_tokens(_build_packed_prompt([]))
+    packs, current, current_tokens = [], [], 0
+    for i in indices:
+        tokens = estimate_tokens(chunks[i])
+        if current and (
+            current_tokens + tokens > settings.GRAPH_PACK_TOKEN_BUDGET
+            or len(current) >= settings.GRAPH_PACK_MAX_CHUNKS
+            or overhead + current_tokens + tokens + _pack_output_tokens(len(current) + 1) > request_budget
+        ):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
 
 
 # --- Core Logic: Neo4j Storage (Global Nodes / Local Edges) ---
 
-async def store_graph_data(document_id: int, user_id: int, graph_data: dict):
+# seq ล่าสุดของ Edge ในเอกสาร (Index relation_doc_user_seq: อ่านจากท้าย Index แถวเดียว)
+# การเขียน Edge ของเอกสารหนึ่งเป็นแบบทีละก้อนอยู่แล้ว (store_lock / Job เดียวต่อเอกสาร) -> seq ไม่ชนกัน
+_LAST_EDGE_SEQ = """
+CALL () {
+    OPTIONAL MATCH ()-[last:RELATION {doc_id: $doc_id, user_id: $user_id}]->()
+    WHERE last.seq IS NOT NULL
+    WITH last
+    ORDER BY last.seq DESC
+    LIMIT 1
+    RETURN coalesce(last.seq, 0) AS last_seq
+}
+"""
+
+async def store_graph_data(document_id: int, user_id: int, graph_data: dict) -> bool:
+    """คืนค่า False ถ้าเขียน Neo4j ไม่สำเร็จ (กราฟของเอกสารนี้ไม่ครบ)"""
     raw_nodes = graph_data.get("nodes", [])
     raw_edges = graph_data.get("edges", [])
 
     log.info(f"🔍 Raw data - Nodes: {len(raw_nodes)}, Edges: {len(raw_edges)}")
     if not raw_nodes and not raw_edges:
-        return
+        return True
 
     # --- 🛡️ FILTERING LOGIC (Balanced) ---
     valid_nodes = []
@@ -262,7 +537,7 @@ async def store_graph_data(document_id: int, user_id: int, graph_data: dict):
     log.info(f"📊 After filtering - Nodes: {len(nodes)}, Edges: {len(edges)}")
     
     if not nodes and not edges:
-        return
+        return True
 
     # --- 💾 STORAGE LOGIC ---
     # Store nodes first with labels
@@ -272,144 +547,302 @@ async def store_graph_data(document_id: int, user_id: int, graph_data: dict):
             if 'label' not in node:
                 node['label'] = create_readable_label(node['id'], node['type'])
         
+        # doc_ids: เอกสารที่ Node นี้มาจาก (รวม Node ที่ไม่มี Edge) -- ใช้ตอนลบเอกสาร (delete_document_graph)
         node_query = """
         UNWIND $nodes AS n_data
         MERGE (n:Entity {id: n_data.id, user_id: $user_id})
         ON CREATE SET n.type = n_data.type, n.label = n_data.label, n.name = n_data.id
         ON MATCH SET n.type = n_data.type, n.label = n_data.label, n.name = n_data.id
+        SET n.doc_ids = CASE
+            WHEN $doc_id IN coalesce(n.doc_ids, []) THEN n.doc_ids
+            ELSE coalesce(n.doc_ids, []) + $doc_id
+        END
         """
         
         try:
             async with driver.session() as session:
-                await session.run(node_query, nodes=nodes, user_id=user_id)
+                await session.run(node_query, nodes=nodes, user_id=user_id, doc_id=document_id)
             log.info(f"✅ Stored {len(nodes)} nodes with labels")
+            # อัปเดต Dictionary สำหรับ GraphRAG (เฉพาะชื่อใหม่)
+            entity_matcher.add_entities(user_id, [node["id"] for node in nodes])
+            # label/type ของ Node ที่แชร์กับเอกสารอื่นอาจเปลี่ยน -> ETag ของกราฟทุกเอกสารของ User ต้องเปลี่ยน
+            graph_cache.bump(user_id)
         except Exception as e:
             log.error(f"❌ Error storing nodes: {e}")
-            return
+            return False
     
     # Store edges separately
     if edges:
-        edge_query = """
-        UNWIND $edges AS e_data
+        # Edge ใหม่ได้ seq ต่อจากค่าล่าสุดของเอกสาร (ใช้ทำ Pagination ของ Graph API)
+        edge_query = _LAST_EDGE_SEQ + """
+        UNWIND range(0, size($edges) - 1) AS i
+        WITH last_seq, i, $edges[i] AS e_data
         MATCH (source:Entity {id: e_data.source, user_id: $user_id})
         MATCH (target:Entity {id: e_data.target, user_id: $user_id})
         MERGE (source)-[r:RELATION {type: e_data.relation, doc_id: $doc_id, user_id: $user_id}]->(target)
+        ON CREATE SET r.seq = last_seq + i + 1
         """
         
         try:
             async with driver.session() as session:
                 await session.run(edge_query, edges=edges, doc_id=document_id, user_id=user_id)
             log.info(f"✅ Stored {len(edges)} edges for Document {document_id}")
+            graph_cache.bump(user_id)
         except Exception as e:
             log.error(f"❌ Error storing edges: {e}")
+            return False
+    return True
 
 
-async def get_document_graph(document_id: int, user_id: int) -> dict:
+async def build_document_graph(document_id: int, user_id: int, chunks: list[str], check_cancelled=None) -> int:
     """
-    ดึง Nodes และ Edges เฉพาะของเอกสาร ID นี้ สำหรับ user นี้
+    Graph Extraction ของทั้งเอกสาร:
+    1. Chunk ที่เคยทำแล้ว -> ใช้ผลจาก LLM Cache
+    2. ที่เหลือ -> รวมเป็น Pack (หลาย Chunk ต่อ Request) ยิง LLM พร้อมกัน (GRAPH_EXTRACTION_CONCURRENCY)
+       โดยความเร็วจริงถูกคุมด้วย Token Bucket ของ Provider (ไม่ต้อง sleep ตายตัว)
+    3. Pack ที่ Parse ไม่ได้ -> ถอยกลับไปทำทีละ Chunk
+    check_cancelled: async callback ที่ raise ถ้าเอกสารถูกลบระหว่างทาง (เช็กก่อนเขียน Neo4j ทุกครั้ง)
+    คืนค่าจำนวน Chunk ที่ Extract/เขียนไม่สำเร็จ (0 = กราฟครบ)
     """
-    # First, let's check if there are any relationships for this document
-    check_query = """
-    MATCH ()-[r {doc_id: $doc_id, user_id: $user_id}]->()
-    RETURN count(r) as edge_count
+    if settings.GRAPH_MAX_CHUNKS_PER_DOCUMENT > 0:
+        chunks = chunks[:settings.GRAPH_MAX_CHUNKS_PER_DOCUMENT]
+    total = len(chunks)
+    if total == 0:
+        return 0
+
+    store_lock = asyncio.Lock() # เขียน Neo4j ทีละก้อน กัน MERGE ชนกันเอง
+    done = 0
+    failed = 0
+
+    async def store(graph_data: dict | None):
+        nonlocal done, failed
+        async with store_lock:
+            if check_cancelled is not None:
+                await check_cancelled()
+            if graph_data is None or not await store_graph_data(document_id, user_id, graph_data):
+                failed += 1
+            done += 1
+        log.info(f"🧠 Graph extraction {done}/{total} chunks (Doc ID: {document_id})")
+
+    # 1. Cache (ผลแบบ Chunk เดียวก่อน; ผลแบบ Packed ใช้ได้เฉพาะตอนเปิด Packed Mode)
+    keys = [llm_cache.make_key(GRAPH_EXTRACTION_MODEL, GRAPH_PROMPT_VERSION, chunk) for chunk in chunks]
+    packed_keys = [llm_cache.make_key(GRAPH_EXTRACTION_MODEL, GRAPH_PACKED_PROMPT_VERSION, chunk) for chunk in chunks]
+    lookup_keys = keys + packed_keys if settings.GRAPH_PACKED_EXTRACTION else keys
+    cached = await llm_cache.get_many(lookup_keys)
+
+    uncached = []
+    for i, key in enumerate(keys):
+        graph_data = cached.get(key)
+        if graph_data is None and settings.GRAPH_PACKED_EXTRACTION:
+            graph_data = cached.get(packed_keys[i])
+        if graph_data is None:
+            uncached.append(i)
+        else:
+            await store(graph_data)
+    metrics.incr("llm_cache.graph.hit", total - len(uncached))
+    metrics.incr("llm_cache.graph.miss", len(uncached))
+
+    # 2. Packs (Pack ละ 1 Chunk ถ้าปิด Packed Mode)
+    if settings.GRAPH_PACKED_EXTRACTION:
+        packs = _pack_chunks(uncached, chunks, int(llm_limiter.get_limiter().tokens.capacity))
+    else:
+        packs = [[i] for i in uncached]
+    if packs:
+        log.info(f"📦 {len(uncached)} uncached chunks -> {len(packs)} LLM request(s)")
+
+    pending = iter(packs)
+
+    async def worker():
+        for pack in pending:
+            if len(pack) == 1:
+                await store(await extract_graph_from_text(chunks[pack[0]], use_cache=False))
+                continue
+            try:
+                results = await _extract_graph_packed_with_llm([chunks[i] for i in pack])
+            except Exception as e:
+                # 3. Fallback: ทีละ Chunk
+                log.warning(f"Packed extraction failed ({e}). Falling back to {len(pack)} single-chunk calls.")
+                metrics.incr("graph.packed.fallback")
+                for i in pack:
+                    await store(await extract_graph_from_text(chunks[i], use_cache=False))
+                continue
+            for i, graph_data in zip(pack, results):
+                await llm_cache.put(packed_keys[i], GRAPH_EXTRACTION_MODEL, graph_data)
+                await store(graph_data)
+
+    concurrency = max(1, min(settings.GRAPH_EXTRACTION_CONCURRENCY, len(packs)))
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        # Worker หนึ่งล้ม (เช่น Job ถูกยกเลิก) -> หยุดตัวอื่นด้วย ไม่ให้ยิง LLM / เขียนกราฟต่อ
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        raise
+
+    await llm_cache.evict()
+    if failed:
+        log.warning(f"⚠️ Graph extraction incomplete: {failed}/{total} chunks failed (Doc ID: {document_id})")
+    return failed
+
+
+async def copy_document_graph(
+    source_document_id: int,
+    source_user_id: int,
+    document_id: int,
+    user_id: int
+) -> int:
     """
-    
-    nodes_dict = {}
-    edges_list = []
-    
+    Dedup: คัดลอกความสัมพันธ์ของเอกสารต้นทาง มาเป็นของเอกสารใหม่ (และ User ใหม่ ถ้าต่างคนกัน)
+    โดยไม่ต้องเรียก LLM ซ้ำ
+    """
+    # Node ของเอกสารต้นทางทั้งหมด (รวมที่ไม่มี Edge) -> เป็นของเอกสารใหม่ด้วย
+    copy_nodes_query = """
+    MATCH (a:Entity {user_id: $source_user_id})
+    WHERE $source_doc_id IN a.doc_ids
+    MERGE (a2:Entity {id: a.id, user_id: $user_id})
+    ON CREATE SET a2.type = a.type, a2.label = a.label, a2.name = a.name
+    SET a2.doc_ids = CASE
+        WHEN $doc_id IN coalesce(a2.doc_ids, []) THEN a2.doc_ids
+        ELSE coalesce(a2.doc_ids, []) + $doc_id
+    END
+    """
+    copy_query = _LAST_EDGE_SEQ + """
+    MATCH (a:Entity {user_id: $source_user_id})-[r:RELATION {doc_id: $source_doc_id, user_id: $source_user_id}]->(b:Entity {user_id: $source_user_id})
+    WITH last_seq, a, r, b
+    ORDER BY r.seq
+    WITH last_seq, collect([a, r, b]) AS rows
+    UNWIND range(0, size(rows) - 1) AS i
+    WITH last_seq, i, rows[i][0] AS a, rows[i][1] AS r, rows[i][2] AS b
+    MERGE (a2:Entity {id: a.id, user_id: $user_id})
+    ON CREATE SET a2.type = a.type, a2.label = a.label, a2.name = a.name
+    MERGE (b2:Entity {id: b.id, user_id: $user_id})
+    ON CREATE SET b2.type = b.type, b2.label = b.label, b2.name = b.name
+    MERGE (a2)-[r2:RELATION {type: r.type, doc_id: $doc_id, user_id: $user_id}]->(b2)
+    ON CREATE SET r2.seq = last_seq + i + 1
+    FOREACH (node IN [a2, b2] |
+        SET node.doc_ids = CASE
+            WHEN $doc_id IN coalesce(node.doc_ids, []) THEN node.doc_ids
+            ELSE coalesce(node.doc_ids, []) + $doc_id
+        END
+    )
+    RETURN count(*) AS copied
+    """
+    async with driver.session() as session:
+        await (await session.run(
+            copy_nodes_query,
+            source_user_id=source_user_id,
+            source_doc_id=source_document_id,
+            user_id=user_id,
+            doc_id=document_id
+        )).consume()
+        result = await session.run(
+            copy_query,
+            source_user_id=source_user_id,
+            source_doc_id=source_document_id,
+            user_id=user_id,
+            doc_id=document_id
+        )
+        record = await result.single()
+    copied = record["copied"] if record else 0
+    # Entity ชุดใหม่ของ User -> โหลด Dictionary ใหม่ตอน Query ครั้งถัดไป
+    entity_matcher.invalidate(user_id)
+    graph_cache.bump(user_id)
+    log.info(f"♻️ Copied {copied} edges from Document {source_document_id} -> {document_id}")
+    return copied
+
+
+# 1 Query ต่อ 1 หน้า: Keyset Pagination ด้วย r.seq ผ่าน Index relation_doc_user_seq
+# (Seek ไปที่ seq > cursor แล้วอ่านตามลำดับ Index แค่ limit แถว -- ไม่ต้อง Sort ทุก Edge ของเอกสารทุกหน้า)
+# Nodes ของหน้านั้นถูก Dedup ใน Neo4j เลย (collect DISTINCT) -- ข้ามหน้าอาจซ้ำได้ ให้ Client รวมเอง
+GRAPH_PAGE_QUERY = """
+MATCH (n:Entity {user_id: $user_id})-[r:RELATION {doc_id: $doc_id, user_id: $user_id}]->(m:Entity {user_id: $user_id})
+WHERE r.seq > $after
+WITH n, r, m
+ORDER BY r.seq
+LIMIT $limit
+WITH collect({source: n.id, target: m.id, relation: r.type, seq: r.seq}) AS edges,
+     collect(DISTINCT n) + collect(DISTINCT m) AS endpoints
+UNWIND endpoints AS node
+WITH edges, collect(DISTINCT node {.id, .label, .type}) AS nodes
+RETURN nodes, edges
+"""
+
+# ก่อนหน้าแรก (Edge เก่าที่ Backfill แล้วมี seq ติดลบ)
+_GRAPH_PAGE_START = -(2 ** 63)
+
+
+def encode_graph_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(str(seq).encode("ascii")).decode("ascii")
+
+
+def decode_graph_cursor(cursor: str) -> int:
+    """ValueError ถ้า Cursor ไม่ถูกต้อง"""
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii"))
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid graph cursor") from e
+
+
+def _graph_node(node: dict) -> dict:
+    node_type = node.get("type") or "Unknown"
+    # Use stored label if available, otherwise create one
+    label = node.get("label") or create_readable_label(node["id"], node_type)
+    return {"id": node["id"], "label": label, "type": node_type}
+
+
+async def get_document_graph(
+    document_id: int,
+    user_id: int,
+    cursor: str | None = None,
+    limit: int | None = None
+) -> dict:
+    """
+    ดึง Nodes และ Edges เฉพาะของเอกสาร ID นี้ สำหรับ user นี้ ทีละหน้า (ไม่เกิน limit edges)
+    คืนค่า {"nodes", "edges", "next_cursor"} -- next_cursor = None แปลว่าหน้าสุดท้าย
+    """
+    limit = limit or settings.GRAPH_PAGE_SIZE
+    after = decode_graph_cursor(cursor) if cursor else _GRAPH_PAGE_START
+
+    nodes = []
+    edges = []
+    next_cursor = None
+
     try:
         async with driver.session() as session:
-            # Check edge count first
-            check_result = await session.run(check_query, doc_id=document_id, user_id=user_id)
-            check_record = await check_result.single()
-            edge_count = check_record["edge_count"] if check_record else 0
-            
-            if edge_count == 0:
-                # Try to get all nodes that might be related (even without doc_id)
+            result = await session.run(
+                GRAPH_PAGE_QUERY, doc_id=document_id, user_id=user_id, after=after, limit=limit
+            )
+            record = await result.single()
+
+            if record:
+                nodes = [_graph_node(node) for node in record["nodes"] if node.get("id")]
+                edges = [
+                    {
+                        "source": edge["source"],
+                        "target": edge["target"],
+                        "relation": format_relation_label(edge["relation"] or "RELATED_TO")
+                    }
+                    for edge in record["edges"]
+                ]
+                if len(record["edges"]) == limit:
+                    next_cursor = encode_graph_cursor(record["edges"][-1]["seq"])
+
+            elif cursor is None:
+                # เอกสารนี้ไม่มี Edge เลย -> แสดง Nodes ของ User แทน (เหมือนเดิม)
                 fallback_query = """
                 MATCH (n:Entity {user_id: $user_id})
-                RETURN n
+                RETURN n {.id, .label, .type} AS n
                 LIMIT 100
                 """
                 result = await session.run(fallback_query, user_id=user_id)
-                async for record in result:
-                    n = record["n"]
-                    n_id = n.get("id")
-                    if n_id:
-                        # Use stored label if available, otherwise create one
-                        stored_label = n.get("label")
-                        if stored_label:
-                            readable_label = stored_label
-                        else:
-                            n_type = n.get("type", "Unknown")
-                            readable_label = create_readable_label(n_id, n_type)
-                        
-                        nodes_dict[n_id] = {
-                            "id": n_id, 
-                            "label": readable_label, 
-                            "type": n.get("type", "Unknown")
-                        }
-            else:
-                # Get nodes and edges for this specific document
-                main_query = """
-                MATCH (n:Entity {user_id: $user_id})-[r {doc_id: $doc_id, user_id: $user_id}]->(m:Entity {user_id: $user_id})
-                RETURN n, r, m
-                LIMIT 2000
-                """
-                result = await session.run(main_query, doc_id=document_id, user_id=user_id)
-                
-                async for record in result:
-                    n = record["n"]
-                    n_id = n.get("id")
-                    if n_id and n_id not in nodes_dict:
-                        # Use stored label if available
-                        stored_label = n.get("label")
-                        if stored_label:
-                            readable_label = stored_label
-                        else:
-                            n_type = n.get("type", "Unknown")
-                            readable_label = create_readable_label(n_id, n_type)
-                        
-                        nodes_dict[n_id] = {
-                            "id": n_id, 
-                            "label": readable_label, 
-                            "type": n.get("type", "Unknown")
-                        }
-
-                    m = record["m"]
-                    m_id = m.get("id")
-                    if m_id and m_id not in nodes_dict:
-                        # Use stored label if available
-                        stored_label = m.get("label")
-                        if stored_label:
-                            readable_label = stored_label
-                        else:
-                            m_type = m.get("type", "Unknown")
-                            readable_label = create_readable_label(m_id, m_type)
-                        
-                        nodes_dict[m_id] = {
-                            "id": m_id, 
-                            "label": readable_label, 
-                            "type": m.get("type", "Unknown")
-                        }
-
-                    r = record["r"]
-                    relation_type = r.get("type", "RELATED_TO")
-                    edges_list.append({
-                        "source": n_id,
-                        "target": m_id,
-                        "relation": format_relation_label(relation_type)
-                    })
-                    
+                nodes = [_graph_node(record["n"]) async for record in result if record["n"].get("id")]
+
     except Exception as e:
         log.error(f"❌ Error fetching graph for document {document_id}: {e}")
-        
-    result = {
-        "nodes": list(nodes_dict.values()),
-        "edges": edges_list
-    }
-    
-    return result
+
+    return {"nodes": nodes, "edges": edges, "next_cursor": next_cursor}
 
 
 async def query_graph_context(query_text: str, user_id: int, doc_id: int = None) -> str:
@@ -417,7 +850,112 @@ async def query_graph_context(query_text: str, user_id: int, doc_id: int = None)
     GraphRAG: ค้นหาข้อมูลจากกราฟ (แบบ User-specific)
     """
     log.info(f"🧠 GraphRAG processing question: '{query_text[:100]}{'...' if len(query_text) > 100 else ''}'")
-    
+
+    # 1. หา Entity ที่มีอยู่จริงในกราฟ จาก Dictionary ใน Memory (ไม่ต้องเรียก LLM)
+    entity_ids = []
+    try:
+        matcher = await get_entity_matcher(user_id)
+        entity_ids = matcher.find(query_text, limit=settings.GRAPH_QUERY_MAX_ENTITIES)
+    except Exception as e:
+        log.error(f"Entity matching failed: {e}")
+
+    if entity_ids:
+        metrics.incr("graph.query.dictionary_match")
+        log.info(f"📋 GraphRAG entities matched: {entity_ids}")
+        # ได้ id ตรงตัว -> ใช้ Index (Entity.id, user_id) ได้เลย
+        match_clause = """
+        MATCH (n:Entity {user_id: $user_id})
+        WHERE n.id IN $entities
+        """
+        return await _query_graph_paths(match_clause, entity_ids, user_id, doc_id)
+
+    if not settings.GRAPH_QUERY_LLM_FALLBACK:
+        log.info("❌ No known entities found in question for GraphRAG")
+        return ""
+
+    # 2. Fallback: ให้ LLM ดึงคำสำคัญ แล้วค้นแบบ CONTAINS
+    metrics.incr("graph.query.llm_fallback")
+    entities = await _extract_query_terms_with_llm(query_text)
+    if not entities:
+        log.info("❌ No entities extracted for GraphRAG")
+        return ""
+
+    # ค้นผ่าน Full-text Index (Lucene) -- Index เป็นของทุก User จึงกรอง user_id หลังได้ผล
+    match_clause = """
+    UNWIND $entities AS term
+    CALL (term) {
+        CALL db.index.fulltext.queryNodes("entity_name_fulltext", term) YIELD node, score
+        WITH node, score
+        WHERE node.user_id = $user_id
+        RETURN node AS n
+        ORDER BY score DESC
+        LIMIT $nodes_per_term
+    }
+    WITH DISTINCT n
+    """
+    queries = [query for query in (_fulltext_query(term) for term in entities) if query]
+    return await _query_graph_paths(match_clause, queries, user_id, doc_id)
+
+
+# กันโหลด Dictionary ของ User เดียวกันซ้ำพร้อมกันหลาย Request
+_entity_matcher_lock = asyncio.Lock()
+# Task โหลดใหม่เบื้องหลัง (Matcher ที่ stale) -- เก็บ Reference ไว้ไม่ให้ถูก GC
+_entity_matcher_reloads: set[asyncio.Task] = set()
+
+
+async def _load_entity_matcher(user_id: int) -> entity_matcher.EntityMatcher:
+    async with driver.session() as session:
+        result = await session.run(
+            "MATCH (n:Entity {user_id: $user_id}) RETURN n.id AS id",
+            user_id=user_id
+        )
+        entity_ids = [record["id"] async for record in result]
+    # สร้าง Automaton ใน Thread (Dictionary ใหญ่ใช้เวลาระดับวินาที)
+    matcher = await entity_matcher.build_matcher(entity_ids)
+    log.info(f"📖 Loaded entity dictionary for user {user_id} ({matcher.size} names)")
+    return matcher
+
+
+async def _reload_entity_matcher(user_id: int, stale: entity_matcher.EntityMatcher):
+    """โหลดใหม่เบื้องหลัง ระหว่างนั้น Query ยังใช้ Matcher ตัวเดิม แล้วค่อยสลับ"""
+    stale.rebuilding = True
+    stale.capture()
+    try:
+        matcher = await _load_entity_matcher(user_id)
+        # ชื่อที่ store_graph_data เพิ่มเข้าตัวเดิมระหว่างโหลด
+        matcher.add(stale.end_capture())
+        if entity_matcher.get(user_id) is stale:
+            entity_matcher.put(user_id, matcher)
+    except Exception as e:
+        log.error(f"Entity dictionary reload failed for user {user_id}: {e}")
+    finally:
+        stale.end_capture()
+        stale.rebuilding = False
+
+
+async def get_entity_matcher(user_id: int) -> entity_matcher.EntityMatcher:
+    """
+    Dictionary ของ Entity ของ User (โหลดจาก Neo4j ครั้งแรก แล้วอัปเดตต่อจาก store_graph_data)
+    """
+    matcher = entity_matcher.get(user_id)
+    if matcher is not None:
+        if matcher.stale and not matcher.rebuilding:
+            task = asyncio.create_task(_reload_entity_matcher(user_id, matcher))
+            _entity_matcher_reloads.add(task)
+            task.add_done_callback(_entity_matcher_reloads.discard)
+        return matcher
+
+    async with _entity_matcher_lock:
+        matcher = entity_matcher.get(user_id)
+        if matcher is not None:
+            return matcher
+
+        matcher = await _load_entity_matcher(user_id)
+        entity_matcher.put(user_id, matcher)
+        return matcher
+
+
+async def _extract_query_terms_with_llm(query_text: str) -> list[str]:
     # Try LLM extraction first, with fallback to simple parsing
     entities = []
     
@@ -459,67 +997,185 @@ Return JSON format: {{"terms": ["term1", "term2", "term3"]}}"""
     except Exception as e:
         log.error(f"LLM extraction failed: {e}")
         # Fallback to simple regex extraction
-        import re
         words = re.findall(r'\b[A-Z][a-zA-Z]+(?:\s+[A-Z][a-zA-Z]+)*\b', query_text)
         stopwords = {'What', 'How', 'When', 'Where', 'Why', 'Who', 'The', 'This', 'That', 'These', 'Those', 'Which', 'Can', 'Does', 'Is', 'Are'}
         entities = [word for word in words if word not in stopwords and len(word) > 2][:5]
         
         if entities:
             log.info(f"📋 GraphRAG fallback entities: {entities}")
-    
-    if not entities:
-        log.info("❌ No entities extracted for GraphRAG")
-        return ""
 
-    # Search graph with extracted entities
-    cypher_query = """
-    UNWIND $entities AS target_name
-    MATCH (n:Entity {user_id: $user_id})
-    WHERE toLower(n.id) CONTAINS toLower(target_name)
+    return entities
+
+
+_LUCENE_SPECIAL = re.compile(r'([+\-!(){}\[\]^"~*?:\\/]|&&|\|\|)')
+
+
+def _fulltext_query(term: str) -> str:
     """
-    
-    if doc_id:
-        cypher_query += """
-        MATCH (n)-[r {doc_id: $doc_id, user_id: $user_id}]-(neighbor:Entity {user_id: $user_id})
-        """
-    else:
-        cypher_query += """
-        MATCH (n)-[r {user_id: $user_id}]-(neighbor:Entity {user_id: $user_id})
-        """
+    แปลงคำค้นเป็น Lucene query: ทุกคำต้องตรง (AND) และ Escape อักขระพิเศษ
+    """
+    words = [_LUCENE_SPECIAL.sub(r"\\\1", word) for word in term.split()]
+    return " AND ".join(word for word in words if word)
+
 
-    cypher_query += """
-    RETURN n.id AS source, r.type AS rel, neighbor.id AS target
-    LIMIT 30
+def _build_path_query(match_clause: str, doc_id: int | None, max_hops: int) -> str:
+    """
+    สร้าง Cypher สำหรับขยาย Path จาก n ได้สูงสุด max_hops ใน Round trip เดียว
+    - แต่ละ Hop เป็น CALL subquery ที่มี LIMIT (จำกัด Fan-out ต่อ Node)
+    - Hop ที่ 2 เป็นต้นไปใช้ OPTIONAL MATCH -> ได้ Path สั้นกว่าก็ต่อเมื่อต่อไม่ได้แล้ว (ไม่คืน Prefix ซ้ำ)
+    - จัดอันดับใน Neo4j ก่อนตัด (Path ที่ผ่าน Entity ที่ถามถึงอีกตัวก่อน แล้วสั้นก่อน) และ LIMIT ต่อ Entity ต้นทาง
+    - Match แบบไม่สนทิศทาง -> คืน forward ต่อ Hop (Edge ชี้จาก Node ก่อนหน้าไป Node ถัดไปหรือไม่)
+    """
+    rel_filter = "{doc_id: $doc_id, user_id: $user_id}" if doc_id else "{user_id: $user_id}"
+    hops = range(1, max_hops + 1)
+    cypher_query = match_clause + f"""
+    WITH collect(DISTINCT n) AS starts
+    UNWIND starts AS n
+    CALL (n, starts) {{
+        CALL (n) {{
+            MATCH (n)-[r1:RELATION {rel_filter}]-(x1:Entity {{user_id: $user_id}})
+            WHERE x1 <> n
+            RETURN r1, x1
+            LIMIT $neighbors_per_entity
+        }}
     """
+    for hop in hops[1:]:
+        previous = ", ".join(["n"] + [f"x{i}" for i in range(1, hop)])
+        cypher_query += f"""
+        CALL ({previous}) {{
+            OPTIONAL MATCH (x{hop - 1})-[r{hop}:RELATION {rel_filter}]-(x{hop}:Entity {{user_id: $user_id}})
+            WHERE NOT x{hop} IN [{previous}]
+            RETURN r{hop}, x{hop}
+            LIMIT $fanout_per_hop
+        }}
+    """
+    cypher_query += f"""
+        WITH starts, [{", ".join(f"r{i}.type" for i in hops)}] AS rels, [{", ".join(f"x{i}" for i in hops)}] AS hops,
+             [{", ".join(f"startNode(r{i}) = {'n' if i == 1 else f'x{i - 1}'}" for i in hops)}] AS forward
+        WITH rels, hops, forward,
+             size([x IN hops WHERE x IS NOT NULL]) AS length,
+             size([x IN hops WHERE x IS NOT NULL AND x IN starts]) > 0 AS bridge
+        RETURN rels, [x IN hops | x.id] AS nodes, forward, bridge
+        ORDER BY bridge DESC, length
+        LIMIT $paths_per_entity
+    }}
+    RETURN n.id AS source, rels, nodes, forward, bridge
+    """
+    return cypher_query
 
-    context_lines = []
+
+# (source, rels, nodes, bridge, forward)
+GraphPath = tuple[str, list[str], list[str], bool, list[bool]]
+
+
+def _path_edges(path: GraphPath) -> frozenset:
+    # เก็บ Edge ตามทิศที่อยู่ในกราฟจริง (ไม่ใช่ทิศที่เดิน): A-B-C กับ C-B-A คือ Path เดียวกัน
+    source, rels, nodes, _, forward = path
+    return frozenset(
+        (previous, rel, node) if is_forward else (node, rel, previous)
+        for previous, rel, node, is_forward in zip([source] + nodes[:-1], rels, nodes, forward)
+    )
+
+
+def _rank_graph_paths(paths: list[GraphPath]) -> list[GraphPath]:
+    """
+    จัดอันดับ Path:
+    1. Path ที่เชื่อม Entity ที่ถามถึง 2 ตัวเข้าหากัน (เช่น "Tesla เกี่ยวกับ Apple อย่างไร") -- สั้นก่อน
+    2. ที่เหลือ: สั้นก่อน และสลับกันหยิบ (Round-robin) ระหว่าง Entity ต้นทาง
+    Path ที่ทุกเส้นอยู่ใน Path อื่นแล้ว (ซ้ำ / เดินกลับทาง / เป็นส่วนหนึ่งของ Path ที่ยาวกว่า) ถูกตัดทิ้ง
+    """
+    edge_sets = [_path_edges(path) for path in paths]
+    kept = []
+    for i, path in enumerate(paths):
+        covered = any(
+            j != i and (edge_sets[i] < edge_sets[j] or (edge_sets[i] == edge_sets[j] and j < i))
+            for j in range(len(paths))
+        )
+        if not covered:
+            kept.append(path)
+
+    kept.sort(key=lambda path: len(path[1]))
+    bridges = [path for path in kept if path[3]]
+    by_source: dict[str, list] = {}
+    for path in kept:
+        if not path[3]:
+            by_source.setdefault(path[0], []).append(path)
+
+    ranked = bridges
+    for round_paths in zip_longest(*by_source.values()):
+        ranked.extend(path for path in round_paths if path)
+    return ranked
+
+
+def _format_graph_path(path: GraphPath) -> str:
+    source, rels, nodes, _, forward = path
+    line = source
+    for rel, node, is_forward in zip(rels, nodes, forward):
+        line += f" --[{rel}]--> {node}" if is_forward else f" <--[{rel}]-- {node}"
+    return line
+
+
+async def _query_graph_paths(match_clause: str, entities: list[str], user_id: int, doc_id: int = None) -> str:
+    """
+    match_clause ต้องให้ตัวแปร n (Entity ที่เจอ) -- ขยาย Path ได้ถึง GRAPH_QUERY_MAX_HOPS
+    แล้วจัดอันดับและตัดให้ไม่เกิน GRAPH_QUERY_MAX_PATHS / GRAPH_CONTEXT_TOKEN_BUDGET
+    """
+    max_hops = max(1, settings.GRAPH_QUERY_MAX_HOPS)
+    cypher_query = _build_path_query(match_clause, doc_id, max_hops)
+
+    paths = []
     try:
         async with driver.session() as session:
-            result = await session.run(cypher_query, entities=entities, doc_id=doc_id, user_id=user_id)
+            result = await session.run(
+                cypher_query,
+                entities=entities,
+                doc_id=doc_id,
+                user_id=user_id,
+                nodes_per_term=settings.GRAPH_QUERY_NODES_PER_TERM,
+                neighbors_per_entity=settings.GRAPH_QUERY_NEIGHBORS_PER_ENTITY,
+                fanout_per_hop=settings.GRAPH_QUERY_FANOUT_PER_HOP,
+                # ตัดต่อ Entity ต้นทาง (หลังจัดอันดับแล้ว) -- Entity ท้ายๆ ไม่ถูกเบียดตก
+                paths_per_entity=settings.GRAPH_QUERY_MAX_PATHS
+            )
             async for record in result:
-                source = record['source']
-                rel = record['rel'] 
-                target = record['target']
-                line = f"{source} --[{rel}]--> {target}"
-                context_lines.append(line)
-                
-        if context_lines:
-            log.info(f"🔗 GraphRAG found {len(context_lines)} connections:")
-            for line in context_lines[:3]:  # Show first 3 connections
-                log.info(f"   {line}")
-            if len(context_lines) > 3:
-                log.info(f"   ... and {len(context_lines) - 3} more connections")
-        else:
-            log.info("❌ No graph connections found for extracted entities")
-            
+                # ตัดส่วนท้ายที่เป็น null (Path ที่สั้นกว่า max_hops)
+                length = sum(1 for node in record["nodes"] if node is not None)
+                paths.append((
+                    record["source"], record["rels"][:length], record["nodes"][:length],
+                    record["bridge"], record["forward"][:length]
+                ))
     except Exception as e:
         log.error(f"Error running graph query: {e}")
         return ""
+
+    # ตัดตามจำนวน Path และ Token budget ก่อนใส่ Prompt
+    header = "Knowledge Graph Connections:"
+    budget = settings.GRAPH_CONTEXT_TOKEN_BUDGET - estimate_tokens(header)
+    context_lines = []
+    for path in _rank_graph_paths(paths):
+        line = _format_graph_path(path)
+        cost = estimate_tokens(line)
+        if cost > budget:
+            continue
+        context_lines.append(line)
+        budget -= cost
+        if len(context_lines) >= settings.GRAPH_QUERY_MAX_PATHS:
+            break
+
+    if context_lines:
+        multi_hop = sum(1 for line in context_lines if line.count("--[") > 1)
+        log.info(f"🔗 GraphRAG selected {len(context_lines)}/{len(paths)} paths ({multi_hop} multi-hop):")
+        for line in context_lines[:3]:  # Show first 3 connections
+            log.info(f"   {line}")
+        if len(context_lines) > 3:
+            log.info(f"   ... and {len(context_lines) - 3} more connections")
+    else:
+        log.info("❌ No graph connections found for extracted entities")
             
     if not context_lines:
         return ""
         
-    graph_context = "Knowledge Graph Connections:\n" + "\n".join(context_lines)
+    graph_context = header + "\n" + "\n".join(context_lines)
     log.info(f"✅ GraphRAG returning {len(graph_context)} character context")
     return graph_context
 
@@ -527,18 +1183,72 @@ Return JSON format: {{"terms": ["term1", "term2", "term3"]}}"""
 async def delete_document_graph(document_id: int, user_id: int):
     """
     ลบเส้นความสัมพันธ์ของเอกสารนี้ และลบ Node ที่ไม่เหลือความสัมพันธ์ใดๆ (สำหรับ user นี้เท่านั้น)
+    - ตรวจเฉพาะ Entity ที่เอกสารนี้แตะ: ปลายของ Edge + Node ที่มีเอกสารนี้ใน doc_ids (รวม Node ที่ไม่มี Edge)
+    - ลบเป็น Batch ละ GRAPH_DELETE_BATCH_SIZE แถว (CALL { } IN TRANSACTIONS) -> Transaction ไม่บวมกับกราฟใหญ่
+    รันจาก Job "graph_cleanup" (Background) -- Error จะถูกโยนต่อเพื่อให้ Job Retry
     """
+    batch_size = settings.GRAPH_DELETE_BATCH_SIZE
+
+    # CALL { } IN TRANSACTIONS ใช้ได้เฉพาะ Auto-commit (session.run) เท่านั้น
     async with driver.session() as session:
-        # 1. ลบเส้น (Edges) ทั้งหมดที่มี doc_id นี้
-        await session.run("""
-            MATCH ()-[r {doc_id: $doc_id, user_id: $user_id}]->()
-            DELETE r
+        # 1. Entity ที่เอกสารนี้แตะ (ต้องเก็บก่อนลบเส้น)
+        result = await session.run("""
+            MATCH (a:Entity {user_id: $user_id})-[:RELATION {doc_id: $doc_id, user_id: $user_id}]->(b:Entity {user_id: $user_id})
+            UNWIND [a.id, b.id] AS entity_id
+            RETURN collect(DISTINCT entity_id) AS entity_ids
         """, doc_id=document_id, user_id=user_id)
-        
-        # 2. ลบ Node กำพร้า (Orphan Nodes)
-        # Node ไหนที่ไม่มีเส้นเข้าหรือออกเลย ให้ลบทิ้ง
-        await session.run("""
+        record = await result.single()
+        entity_ids = set(record["entity_ids"] if record else [])
+
+        # + Entity ที่บันทึกว่ามาจากเอกสารนี้ (รวม Node ที่ไม่มี Edge)
+        result = await session.run("""
             MATCH (n:Entity {user_id: $user_id})
-            WHERE NOT (n)--()
-            DELETE n
-        """, user_id=user_id)
\ No newline at end of file
+            WHERE $doc_id IN n.doc_ids
+            RETURN collect(n.id) AS entity_ids
+        """, doc_id=document_id, user_id=user_id)
+        record = await result.single()
+        entity_ids.update(record["entity_ids"] if record else [])
+        entity_ids = list(entity_ids)
+
+        # 2. ลบเส้น (Edges) ทั้งหมดที่มี doc_id นี้ ทีละ Batch
+        result = await session.run("""
+            MATCH ()-[r:RELATION {doc_id: $doc_id, user_id: $user_id}]->()
+            CALL (r) {
+                DELETE r
+            } IN TRANSACTIONS OF $batch_size ROWS
+        """, doc_id=document_id, user_id=user_id, batch_size=batch_size)
+        summary = await result.consume()
+        deleted_edges = summary.counters.relationships_deleted
+
+        # 3. ลบ Node กำพร้า (Orphan Nodes) เฉพาะใน Entity ที่แตะ
+        # Node ไหนที่ไม่มีเส้นเข้าหรือออกเลย และไม่เป็นของเอกสารอื่น ให้ลบทิ้ง
+        result = await session.run("""
+            UNWIND $entity_ids AS entity_id
+            MATCH (n:Entity {id: entity_id, user_id: $user_id})
+            WHERE NOT (n)--() AND size([d IN coalesce(n.doc_ids, []) WHERE d <> $doc_id]) = 0
+            CALL (n) {
+                DELETE n
+            } IN TRANSACTIONS OF $batch_size ROWS
+        """, entity_ids=entity_ids, doc_id=document_id, user_id=user_id, batch_size=batch_size)
+        summary = await result.consume()
+        deleted_nodes = summary.counters.nodes_deleted
+
+        # 4. เอาเอกสารนี้ออกจาก doc_ids ของ Node ที่เหลือ (ทำท้ายสุด -> ถ้า Job ล้มกลางทาง รอบ Retry ยังหา Node เจอ)
+        result = await session.run("""
+            UNWIND $entity_ids AS entity_id
+            MATCH (n:Entity {id: entity_id, user_id: $user_id})
+            WHERE $doc_id IN n.doc_ids
+            CALL (n) {
+                SET n.doc_ids = [d IN n.doc_ids WHERE d <> $doc_id]
+            } IN TRANSACTIONS OF $batch_size ROWS
+        """, entity_ids=entity_ids, doc_id=document_id, user_id=user_id, batch_size=batch_size)
+        await result.consume()
+
+    log.info(
+        f"🧹 Graph cleanup for Document {document_id}: {deleted_edges} edges, "
+        f"{deleted_nodes}/{len(entity_ids)} touched entities orphaned and removed"
+    )
+
+    # Node ที่ถูกลบอาจยังอยู่ใน Dictionary -> โหลดใหม่ตอน Query ครั้งถัดไป
+    entity_matcher.invalidate(user_id)
+    graph_cache.bump(user_id)
\ No newline at end of file
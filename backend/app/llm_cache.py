@@ -0,0 +1,127 @@
+import datetime
+import hashlib
+import json
+import logging
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from app import models
+from app.config import settings
+from app.database import SessionLocal
+
+log = logging.getLogger("uvicorn.error")
+
+
+def make_key(model: str, prompt_version: str, text: str) -> str:
+    """
+    Key ของ Cache = SHA-256 ของ (model, prompt version, text)
+    """
+    return hashlib.sha256(f"{model}\x00{prompt_version}\x00{text}".encode("utf-8")).hexdigest()
+
+
+def _expiry_cutoff() -> datetime.datetime:
+    return datetime.datetime.utcnow() - datetime.timedelta(days=settings.LLM_CACHE_TTL_DAYS)
+
+
+async def get(key: str) -> dict | None:
+    """
+    คืนค่าผลลัพธ์ที่เคย Cache ไว้ (ถ้ายังไม่หมดอายุ) -- Cache พังต้องไม่ทำให้ Pipeline พัง
+    """
+    try:
+        async with SessionLocal() as db:
+            stmt = (
+                sa.update(models.LLMCacheEntry)
+                .where(models.LLMCacheEntry.key == key)
+                .where(models.LLMCacheEntry.created_at >= _expiry_cutoff())
+                .values(last_accessed_at=datetime.datetime.utcnow())
+                .returning(models.LLMCacheEntry.response)
+            )
+            result = await db.execute(stmt)
+            response = result.scalar_one_or_none()
+            await db.commit()
+            return response
+    except Exception as e:
+        log.warning(f"LLM cache lookup failed: {e}")
+        return None
+
+
+async def get_many(keys: list[str]) -> dict[str, dict]:
+    """
+    เหมือน get() แต่ค้นทีละหลาย Key ในคำสั่งเดียว -> {key: response}
+    """
+    if not keys:
+        return {}
+    try:
+        async with SessionLocal() as db:
+            stmt = (
+                sa.update(models.LLMCacheEntry)
+                .where(models.LLMCacheEntry.key.in_(set(keys)))
+                .where(models.LLMCacheEntry.created_at >= _expiry_cutoff())
+                .values(last_accessed_at=datetime.datetime.utcnow())
+                .returning(models.LLMCacheEntry.key, models.LLMCacheEntry.response)
+            )
+            result = await db.execute(stmt)
+            responses = {row.key: row.response for row in result}
+            await db.commit()
+            return responses
+    except Exception as e:
+        log.warning(f"LLM cache lookup failed: {e}")
+        return {}
+
+
+async def put(key: str, model: str, response: dict):
+    now = datetime.datetime.utcnow()
+    values = {
+        "key": key,
+        "model": model,
+        "response": response,
+        "size_bytes": len(json.dumps(response)),
+        "created_at": now,
+        "last_accessed_at": now,
+    }
+    try:
+        async with SessionLocal() as db:
+            stmt = insert(models.LLMCacheEntry).values(**values)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[models.LLMCacheEntry.key],
+                set_={k: stmt.excluded[k] for k in ("response", "size_bytes", "created_at", "last_accessed_at")},
+            )
+            await db.execute(stmt)
+            await db.commit()
+    except Exception as e:
+        log.warning(f"LLM cache write failed: {e}")
+
+
+async def evict():
+    """
+    ลบรายการที่หมดอายุ (TTL) แล้วตัดรายการที่ไม่ได้ใช้นานสุดออกจนขนาดรวมไม่เกิน LLM_CACHE_MAX_MB
+    """
+    max_bytes = settings.LLM_CACHE_MAX_MB * 1024 * 1024
+    try:
+        async with SessionLocal() as db:
+            expired = await db.execute(
+                sa.delete(models.LLMCacheEntry).where(models.LLMCacheEntry.created_at < _expiry_cutoff())
+            )
+
+            # รวมขนาดสะสมจากรายการที่ใช้ล่าสุด -> ส่วนที่เกินโควต้าคือรายการที่ต้องลบ
+            running_size = (
+                sa.select(
+                    models.LLMCacheEntry.key,
+                    sa.func.sum(models.LLMCacheEntry.size_bytes)
+                    .over(order_by=models.LLMCacheEntry.last_accessed_at.desc())
+                    .label("running_size"),
+                )
+                .subquery()
+            )
+            over_budget = await db.execute(
+                sa.delete(models.LLMCacheEntry).where(
+                    models.LLMCacheEntry.key.in_(
+                        sa.select(running_size.c.key).where(running_size.c.running_size > max_bytes)
+                    )
+                )
+            )
+            await db.commit()
+
+        if expired.rowcount or over_budget.rowcount:
+            log.info(f"🧹 LLM cache evicted {expired.rowcount} expired + {over_budget.rowcount} over-budget entries")
+    except Exception as e:
+        log.warning(f"LLM cache eviction failed: {e}")
@@ -0,0 +1,119 @@
+import asyncio
+import email.utils
+import logging
+import re
+import time
+from app.config import settings
+
+log = logging.getLogger("uvicorn.error")
+
+
+class TokenBucket:
+    """
+    Token Bucket แบบ async: เติม rate_per_minute หน่วยต่อนาที เก็บได้สูงสุด capacity หน่วย
+    ผู้รอจะได้คิวตามลำดับ (FIFO) ผ่าน Lock
+    """
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.0):
+        # คำขอที่ใหญ่กว่าถังจะรอไม่มีวันจบ -> ตัดให้เท่าความจุ
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+    def adjust(self, amount: float):
+        """ปรับยอด (บวก = คืน token, ลบ = หักเพิ่ม) หลังรู้ยอดใช้จริง"""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+    def pause(self, seconds: float):
+        """หยุดแจก token ชั่วคราว (ใช้ตอนโดน 429 / Retry-After)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+
+
+class ProviderLimiter:
+    """
+    จำกัดทั้ง Requests/min และ Tokens/min ของ LLM Provider หนึ่งเจ้า
+    """
+    def __init__(self, provider: str, requests_per_minute: int, tokens_per_minute: int):
+        self.provider = provider
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, estimated_tokens: int):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int | None):
+        if actual_tokens:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+    def back_off(self, seconds: float):
+        log.warning(f"⏸️ {self.provider} rate limited. Pausing LLM calls for {seconds:.1f}s")
+        self.requests.pause(seconds)
+        self.tokens.pause(seconds)
+
+
+_limiters: dict[str, ProviderLimiter] = {}
+
+
+def get_limiter(provider: str | None = None) -> ProviderLimiter:
+    provider = provider or settings.LLM_PROVIDER
+    if provider not in _limiters:
+        limits = settings.LLM_RATE_LIMITS.get(provider, {})
+        _limiters[provider] = ProviderLimiter(
+            provider,
+            requests_per_minute=limits.get("requests_per_minute", settings.LLM_DEFAULT_REQUESTS_PER_MINUTE),
+            tokens_per_minute=limits.get("tokens_per_minute", settings.LLM_DEFAULT_TOKENS_PER_MINUTE),
+        )
+    return _limiters[provider]
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    """
+    อ่านเวลาที่ต้องรอจาก Error 429: Header "Retry-After" หรือข้อความแบบ "try again in 1m2.5s"
+    """
+    headers = getattr(error, "litellm_response_headers", None)
+    if headers is None:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+    if headers:
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                pass
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    match = re.search(r"try again in (?:(\d+)m)?(\d+(?:\.\d+)?)(ms|s)", str(error))
+    if match:
+        minutes, amount, unit = match.groups()
+        seconds = float(amount) / 1000 if unit == "ms" else float(amount)
+        return int(minutes or 0) * 60 + seconds
+    return None
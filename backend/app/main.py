@@ -2,7 +2,8 @@ import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.config import settings
-from app.knowledge_graph import check_neo4j_connection, close_neo4j_driver
+from app.knowledge_graph import check_neo4j_connection, close_neo4j_driver, ensure_graph_schema, check_graph_schema
+from app import job_queue, metrics
 from app.routers import auth, users, documents
 from app.middlewares.cors import add_cors_middleware
 from app.middlewares.logging import LoggingMiddleware
@@ -22,10 +23,21 @@ async def lifespan(app: FastAPI):
         logger.warning("Could not connect to Neo4j!")
     else:
         logger.info("Connected to Neo4j successfully.")
+        # Create constraints/indexes, then report anything still missing
+        await ensure_graph_schema()
+        missing = await check_graph_schema()
+        if missing:
+            logger.warning(f"Neo4j indexes missing or not online: {', '.join(missing)}")
+        else:
+            logger.info("Neo4j schema (constraints & indexes) is ready.")
+
+    # Start ingestion worker pool (resumes jobs interrupted by a restart)
+    await job_queue.start_workers()
     
     yield # Let the app run
     
-    # App Shutdown: Close connection
+    # App Shutdown: Stop workers, then close connection
+    await job_queue.stop_workers()
     await close_neo4j_driver()
     logger.info("Neo4j driver closed.")
 
@@ -52,3 +64,7 @@ def read_root():
 @app.get("/health")
 def health_check():
     return {"status": "ok"}
+
+@app.get("/metrics")
+def read_metrics():
+    return metrics.snapshot()
@@ -0,0 +1,13 @@
+from collections import defaultdict
+
+# ตัวนับ (Counters) แบบ In-process สำหรับดูว่า Cache/Dedup ช่วยประหยัดงานไปเท่าไหร่
+# ดูค่าได้ที่ GET /metrics
+_counters: dict[str, int] = defaultdict(int)
+
+
+def incr(name: str, amount: int = 1):
+    _counters[name] += amount
+
+
+def snapshot() -> dict[str, int]:
+    return dict(sorted(_counters.items()))
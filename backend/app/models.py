@@ -1,5 +1,6 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, LargeBinary, Index, Computed
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from app.database import Base
 import datetime
 from pgvector.sqlalchemy import Vector
@@ -26,6 +27,12 @@ class Document(Base):
     uploaded_at = Column(DateTime, default=datetime.datetime.utcnow)
     owner_id = Column(Integer, ForeignKey("users.id"))
 
+    # SHA-256 ของไฟล์ -> ไฟล์เดียวกันไม่ต้องประมวลผลซ้ำ
+    content_hash = Column(String(64), index=True, nullable=True)
+
+    # Graph Extraction ครบทุก Chunk (ไม่มี LLM/Neo4j Error) -> ใช้เป็นต้นฉบับให้ Dedup ได้
+    graph_complete = Column(Boolean, nullable=False, default=False, server_default="false")
+
     owner = relationship("User")
     # "บอก" ว่า Document 1 อัน... มี "Chunks" (ลูก) ได้หลายอัน
     chunks = relationship("Chunk", back_populates="document", cascade="all, delete-orphan") 
@@ -44,8 +51,75 @@ class Chunk(Base):
     # (384 คือ "มิติ" (Dimensions) ของ Model ที่เราจะใช้)
     embedding = Column(Vector(384)) 
 
+    # SHA-256 ของ text -> Chunk ที่เหมือนกันใช้ Vector เดิมได้เลย
+    content_hash = Column(String(64), index=True, nullable=True)
+
+    # Full-text (Lexical) ของ text -- Postgres คำนวณเอง (Generated Column) ไม่ต้องเขียนตอน COPY
+    # deferred: ไม่โหลดมาด้วยตอน SELECT Chunk ปกติ
+    text_search = deferred(Column(TSVECTOR, Computed("to_tsvector('english', text)", persisted=True)))
+
     # "กุญแจ" ที่ชี้กลับไปหา "แม่"
     document_id = Column(Integer, ForeignKey("documents.id"))
 
+    # เจ้าของ (Denormalized จาก documents.owner_id) -> Global Search ไม่ต้อง JOIN
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+
     # "ความสัมพันธ์" (Magic)
-    document = relationship("Document", back_populates="chunks")
\ No newline at end of file
+    document = relationship("Document", back_populates="chunks")
+
+    __table_args__ = (
+        # ANN Index (HNSW) สำหรับ l2_distance -- ปรับ Recall/Latency ด้วย hnsw.ef_search ตอน Query
+        Index(
+            "ix_chunks_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_l2_ops"},
+        ),
+        # GIN Index สำหรับ text_search @@ tsquery (Hybrid Retrieval)
+        Index("ix_chunks_text_search", "text_search", postgresql_using="gin"),
+    )
+
+
+# ตาราง "คิวงาน" (Background Jobs) -- เก็บใน Postgres เพื่อไม่ให้งานหายตอน Restart
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+
+    # ประเภทงาน เช่น "ingest_upload", "ingest_sec"
+    kind = Column(String, nullable=False)
+
+    # queued -> running -> done / failed / cancelled
+    status = Column(String, nullable=False, default="queued", index=True)
+    # ขั้นตอนย่อยที่กำลังทำอยู่ เช่น "extracting", "embedding", "graph"
+    stage = Column(String, nullable=True)
+
+    # ไม่ใช้ ForeignKey เพราะงานบางอย่างต้องทำงานต่อได้แม้ Document ถูกลบไปแล้ว
+    document_id = Column(Integer, index=True, nullable=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+
+    # พารามิเตอร์ของงาน (filename, ticker, ...) + ไฟล์ที่อัปโหลด (ถ้ามี)
+    payload = Column(JSONB, nullable=False, default=dict)
+    content = Column(LargeBinary, nullable=True)
+
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    last_error = Column(Text, nullable=True)
+
+    # ห้ามหยิบงานนี้ก่อนเวลานี้ (ใช้ทำ Retry Backoff)
+    run_after = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+
+# ตาราง "Cache คำตอบ LLM" (เช่น Graph Extraction) -- Key = hash(model, prompt version, text)
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True)
+    model = Column(String, nullable=False)
+    response = Column(JSONB, nullable=False)
+    size_bytes = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_accessed_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
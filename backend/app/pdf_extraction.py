@@ -0,0 +1,25 @@
+import asyncio
+import io
+from typing import Iterator
+from pypdf import PdfReader
+
+# แกะข้อความ PDF จาก Memory (ไม่ลงไฟล์) ใน Thread -- ไม่บล็อก Event Loop
+# (เคยลอง Process Pool แบ่งช่วงหน้า: เครื่อง CPU น้อยช้ากว่า Thread เพราะแต่ละ Worker ต้อง Parse PDF เอง + Spawn/IPC
+#  ดู bench_pdf_extraction.py)
+
+
+def iter_pdf_pages(content: bytes) -> Iterator[str]:
+    """yield ข้อความทีละหน้าตามลำดับ (Sync -- เรียกใน Thread)"""
+    reader = PdfReader(io.BytesIO(content))
+    for page in reader.pages:
+        yield page.extract_text() or ""
+
+
+def _extract_text(content: bytes) -> str:
+    # join ครั้งเดียว (ไม่ใช่ += ทีละหน้าที่ Copy ซ้ำทั้งก้อน)
+    return "\n".join(iter_pdf_pages(content))
+
+
+async def extract_pdf_text(content: bytes) -> str:
+    # Crop ต้องเห็นทั้งเอกสาร (หาจุดเริ่ม/จบของ 10-K) -> รวมเป็น String เดียว
+    return await asyncio.to_thread(_extract_text, content)
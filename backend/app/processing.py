@@ -1,26 +1,30 @@
 import asyncio
 import logging
-import os
-import aiofiles
-from pypdf import PdfReader
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import AsyncIterator, Callable
+import numpy as np
 from sentence_transformers import SentenceTransformer, CrossEncoder
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from app import models, crud
+from app import models, crud, schemas
 from app.database import SessionLocal
 from app.config import settings
 import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import TSQUERY
 from litellm import acompletion
 from tenacity import retry, stop_after_attempt, wait_exponential, wait_fixed
-from app import knowledge_graph
+from app import knowledge_graph, pdf_extraction, chunk_writer, metrics, llm_cache
 import re
-from app.utils import smart_crop_content
+from app.utils import smart_crop_content, content_hash, normalize_query, elapsed_ms
+from app.cache import LRUCache
 
-UPLOAD_DIRECTORY = "/app/uploads"
+UPLOAD_DIRECTORY = "/app/uploads" # Legacy: ไฟล์จากเวอร์ชันก่อนที่ยังเขียนลงดิสก์
 log = logging.getLogger("uvicorn.error")
 
 # --- 1. Load Models ---
 log.info("Loading Embedding Model (Bi-Encoder)...")
-EMBEDDING_MODEL = SentenceTransformer("all-MiniLM-L6-v2")
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_MODEL = SentenceTransformer(EMBEDDING_MODEL_NAME)
 
 log.info("Loading Reranker Model (Cross-Encoder)...")
 # ใช้รุ่น ms-marco-MiniLM-L-6-v2 (เล็ก เร็ว แม่น)
@@ -28,88 +32,329 @@ RERANKER_MODEL = CrossEncoder("cross-encoder/ms-marco-MiniLM-L-6-v2")
 log.info("Models loaded.")
 # ----------------------
 
+
+# --- 2. Micro-Batching (รวม request ที่เข้ามาพร้อมกันให้เป็น batch เดียว) ---
+class MicroBatcher:
+    """
+    รับ item ทีละตัวจากหลายๆ request -> รอไม่เกิน max_wait_ms หรือจนครบ max_batch_size
+    -> เรียก fn(items) ครั้งเดียวใน executor (ไม่บล็อก Event Loop) -> แจกผลลัพธ์คืนตามลำดับ
+    """
+    def __init__(
+        self,
+        fn: Callable[[list], list],
+        executor: Executor,
+        max_batch_size: int,
+        max_wait_ms: float,
+        name: str
+    ):
+        self._fn = fn
+        self._executor = executor
+        self._max_batch_size = max(1, max_batch_size)
+        self._max_wait = max_wait_ms / 1000
+        self._name = name
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    async def submit(self, item):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, self._fn, items)
+            except Exception as e:
+                log.error(f"{self._name} batch failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            if len(batch) > 1:
+                log.info(f"📦 {self._name}: served {len(batch)} requests with one batch")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+# --- 3. Embedding Service ---
+class EmbeddingService:
+    """
+    รัน EMBEDDING_MODEL.encode นอก Event Loop
+    - Query: รวมคำถามจากหลาย request เป็น encode() ครั้งเดียว (Micro-Batching)
+    - Document: ใช้ Thread แยก เพื่อไม่ให้การ ingest เอกสารใหญ่ไปแย่งคิวของ Query
+    - Query Cache: LRU ตาม normalized question (+ แชร์ข้าม Process ผ่าน llm_cache ถ้าเปิด)
+    """
+    def __init__(self, model: SentenceTransformer):
+        self._model = model
+        self._query_cache = LRUCache(settings.QUERY_EMBEDDING_CACHE_SIZE, name="query_embedding_cache")
+        self._query_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-query")
+        self._ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed-ingest")
+        self._query_batcher = MicroBatcher(
+            fn=self._encode_queries,
+            executor=self._query_executor,
+            max_batch_size=settings.EMBEDDING_BATCH_MAX_SIZE,
+            max_wait_ms=settings.EMBEDDING_BATCH_MAX_WAIT_MS,
+            name="Query embedding"
+        )
+
+    def _encode_queries(self, texts: list[str]) -> list:
+        return list(self._model.encode(texts, batch_size=len(texts)))
+
+    def _encode_documents(self, texts: list[str]):
+        return self._model.encode(texts, batch_size=settings.EMBEDDING_INGEST_BATCH_SIZE)
+
+    async def embed_query(self, text: str):
+        # all-MiniLM-L6-v2 เป็น uncased -> คำถามที่ต่างกันแค่ตัวพิมพ์/ช่องว่างได้ Vector เดียวกัน
+        normalized = normalize_query(text)
+        embedding = self._query_cache.get(normalized)
+        if embedding is not None:
+            return embedding
+
+        shared_key = None
+        if settings.QUERY_EMBEDDING_SHARED_CACHE:
+            shared_key = llm_cache.make_key(EMBEDDING_MODEL_NAME, "query-embedding", normalized)
+            shared = await llm_cache.get(shared_key)
+            if shared is not None:
+                metrics.incr("query_embedding_cache.shared_hit")
+                embedding = np.asarray(shared["embedding"], dtype=np.float32)
+                self._query_cache.put(normalized, embedding)
+                return embedding
+
+        embedding = await self._query_batcher.submit(text)
+        self._query_cache.put(normalized, embedding)
+        if shared_key is not None:
+            await llm_cache.put(shared_key, EMBEDDING_MODEL_NAME, {"embedding": embedding.tolist()})
+        return embedding
+
+    async def embed_queries(self, texts: list[str]) -> list:
+        """
+        Batch API: คำถามที่ยังไม่อยู่ใน Cache ทั้งหมด -> encode() ครั้งเดียว
+        """
+        normalized = [normalize_query(text) for text in texts]
+        embeddings = [self._query_cache.get(key) for key in normalized]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            encoded = await loop.run_in_executor(
+                self._query_executor, self._encode_queries, [texts[i] for i in missing]
+            )
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self._query_cache.put(normalized[i], embedding)
+        return embeddings
+
+    async def embed_documents(self, texts: list[str]):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._ingest_executor, self._encode_documents, texts)
+
+
+embedding_service = EmbeddingService(EMBEDDING_MODEL)
+
+
+# --- 4. Rerank Service ---
+class RerankService:
+    """
+    รัน RERANKER_MODEL.predict นอก Event Loop
+    - รวม (query, chunk) pairs จากหลาย request เป็น predict() ครั้งเดียว (Micro-Batching)
+    - จำคะแนนของ (normalized query, chunk id) ไว้ใน LRU -> คำถามซ้ำไม่ต้องผ่าน Cross-Encoder
+    """
+    def __init__(self, model: CrossEncoder):
+        self._model = model
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+        self._batcher = MicroBatcher(
+            fn=self._predict,
+            executor=self._executor,
+            max_batch_size=settings.RERANK_BATCH_MAX_SIZE,
+            max_wait_ms=settings.RERANK_BATCH_MAX_WAIT_MS,
+            name="Rerank"
+        )
+        self._scores = LRUCache(settings.RERANK_CACHE_SIZE, name="rerank_score_cache")
+
+    def _predict(self, pairs: list[tuple[str, str]]) -> list[float]:
+        batch_size = min(len(pairs), settings.RERANK_BATCH_MAX_SIZE)
+        return [float(score) for score in self._model.predict(pairs, batch_size=batch_size)]
+
+    async def score(self, query: str, chunks: list[models.Chunk]) -> list[float]:
+        normalized = normalize_query(query)
+        scores = [self._scores.get((normalized, chunk.id)) for chunk in chunks]
+        missing = [i for i, score in enumerate(scores) if score is None]
+
+        if missing:
+            new_scores = await asyncio.gather(
+                *(self._batcher.submit((query, chunks[i].text)) for i in missing)
+            )
+            for i, score in zip(missing, new_scores):
+                scores[i] = score
+                self._scores.put((normalized, chunks[i].id), score)
+        return scores
+
+
+    async def score_many(self, requests: list[tuple[str, list[models.Chunk]]]) -> list[list[float]]:
+        """
+        Batch API: ให้คะแนน (query, chunks) หลายชุด -- Pairs ที่ยังไม่อยู่ใน Cache ทั้งหมด -> predict() ครั้งเดียว
+        """
+        results = []
+        missing_pairs = []
+        missing_slots = []
+        for query, chunks in requests:
+            normalized = normalize_query(query)
+            scores = [self._scores.get((normalized, chunk.id)) for chunk in chunks]
+            for i, score in enumerate(scores):
+                if score is None:
+                    missing_pairs.append((query, chunks[i].text))
+                    missing_slots.append((len(results), i, (normalized, chunks[i].id)))
+            results.append(scores)
+
+        if missing_pairs:
+            loop = asyncio.get_running_loop()
+            new_scores = await loop.run_in_executor(self._executor, self._predict, missing_pairs)
+            for (result_index, i, cache_key), score in zip(missing_slots, new_scores):
+                results[result_index][i] = score
+                self._scores.put(cache_key, score)
+        return results
+
+rerank_service = RerankService(RERANKER_MODEL)
+
 text_splitter = RecursiveCharacterTextSplitter(
     chunk_size=1000,
     chunk_overlap=200,
     length_function=len,
 )
 
+async def embed_chunks_with_dedup(chunks: list[str], chunk_hashes: list[str]) -> list:
+    """
+    Dedup (ระดับ Chunk): ใช้ Vector เดิมของ Chunk ที่ text เหมือนกัน -> Embed เฉพาะตัวที่ยังไม่เคยเห็น
+    """
+    async with SessionLocal() as db:
+        known = await crud.get_embeddings_by_hash(db, chunk_hashes)
+
+    missing = [i for i, h in enumerate(chunk_hashes) if h not in known]
+    metrics.incr("dedup.chunk_embedding.hit", len(chunks) - len(missing))
+    metrics.incr("dedup.chunk_embedding.miss", len(missing))
+    log.info(f"♻️ Reusing {len(chunks) - len(missing)}/{len(chunks)} chunk embeddings")
+
+    new_embeddings = []
+    if missing:
+        new_embeddings = await embedding_service.embed_documents([chunks[i] for i in missing])
+
+    embeddings = [known.get(h) for h in chunk_hashes]
+    for i, embedding in zip(missing, new_embeddings):
+        embeddings[i] = embedding
+    return embeddings
+
+
 async def save_extract_chunk_and_embed(
     document_id: int,
     user_id: int,
     filename: str,
     content_type: str,
-    content: bytes
+    content: bytes,
+    report_stage=None,
+    check_cancelled=None
 ):
-    # ... (ฟังก์ชันนี้เหมือนเดิม 100% ไม่ต้องแก้) ...
-    # (พี่ขอละไว้เพื่อความสั้นนะครับ แต่น้อง Copy ของเดิมมาแปะได้เลย หรือถ้าจะ Copy ทับ ให้บอกพี่ เดี๋ยวพี่แปะตัวเต็มให้)
-    # ... (Logic เดิม: Save File -> Extract -> Chunk -> Embed -> Save DB -> Graph Extract) ...
-    os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
-    file_path = os.path.join(UPLOAD_DIRECTORY, f"doc_{document_id}_{filename}")
+    """
+    Pipeline: Extract (in-memory) -> Chunk -> Embed -> Save DB -> Graph Extract
+    ถูกเรียกจาก Job Queue (app.job_queue) -- ถ้า Error จะ raise ออกไปเพื่อให้คิว Retry
+    report_stage: async callback สำหรับรายงานขั้นตอน (copying / extracting / embedding / graph)
+    check_cancelled: async callback ที่ raise ถ้าเอกสารถูกลบไปแล้ว (เรียกก่อนเขียน Graph แต่ละครั้ง)
+    """
+    async def stage(name: str):
+        if report_stage is not None:
+            await report_stage(name)
 
     log.info(f"--- 🤖 TASK START (Doc ID: {document_id}) ---")
 
     try:
-        async with aiofiles.open(file_path, "wb") as out_file:
-            await out_file.write(content)
-        
+        # 0. Dedup (ระดับไฟล์): ไฟล์เดียวกันเคยประมวลผลเสร็จแล้ว -> คัดลอกผลลัพธ์ ข้ามทั้ง Pipeline
+        file_hash = content_hash(content)
+        async with SessionLocal() as db:
+            await db.execute(
+                sa.update(models.Document)
+                .where(models.Document.id == document_id)
+                .values(content_hash=file_hash)
+            )
+            await db.commit()
+            source_doc = await crud.get_reusable_document(db, file_hash, document_id, user_id)
+
+        if source_doc is not None:
+            metrics.incr("dedup.document.hit")
+            log.info(f"♻️ Identical file already processed (Doc ID: {source_doc.id}). Reusing results.")
+            await stage("copying")
+            await chunk_writer.copy_document_chunks(source_doc.id, document_id, user_id)
+            if check_cancelled is not None:
+                await check_cancelled()
+            await knowledge_graph.copy_document_graph(source_doc.id, source_doc.owner_id, document_id, user_id)
+            async with SessionLocal() as db:
+                await crud.mark_graph_complete(db, document_id)
+            log.info(f"--- 🤖 TASK DONE (Doc ID: {document_id}, deduplicated) ---")
+            return
+        metrics.incr("dedup.document.miss")
+
+        await stage("extracting")
         extracted_text = ""
         if content_type == "application/pdf":
-            reader = PdfReader(file_path)
-            for page in reader.pages:
-                extracted_text += page.extract_text() + "\n"
+            # แกะทีละหน้าใน Thread (อ่านจาก Memory ไม่ต้องลงไฟล์)
+            extracted_text = await pdf_extraction.extract_pdf_text(content)
             log.info("✂️ Cropping PDF content...")
-            extracted_text = smart_crop_content(extracted_text)
+            extracted_text = await asyncio.to_thread(smart_crop_content, extracted_text)
         else:
             extracted_text = content.decode("utf-8")
 
         chunks = text_splitter.split_text(extracted_text)
         
         # RAG Embed
-        embeddings = EMBEDDING_MODEL.encode(chunks)
-        db_chunks = []
-        for i in range(len(chunks)):
-            db_chunks.append(
-                models.Chunk(text=chunks[i], embedding=embeddings[i], document_id=document_id)
-            )
+        await stage("embedding")
+        chunk_hashes = [content_hash(chunk) for chunk in chunks]
+        embeddings = await embed_chunks_with_dedup(chunks, chunk_hashes)
 
-        async with SessionLocal() as db:
-            db.add_all(db_chunks)
-            await db.commit()
+        # Bulk COPY (แทน db.add_all ที่ INSERT ทีละแถว) -- ลบของรอบก่อนให้ด้วยกรณี Retry
+        await chunk_writer.bulk_write_chunks(document_id, user_id, chunks, embeddings, chunk_hashes)
         
-        # Graph Extract (Limit 5)
-        MAX_GRAPH_CHUNKS = 5
-        for i, chunk in enumerate(chunks):
-            if i >= MAX_GRAPH_CHUNKS: break
-            log.info(f"🧠 Processing chunk {i+1}/{min(MAX_GRAPH_CHUNKS, len(chunks))} for graph extraction...")
-            graph_data = await knowledge_graph.extract_graph_from_text(chunk)
-            await knowledge_graph.store_graph_data(document_id, user_id, graph_data)
-            # Small delay only for API courtesy (retries handle rate limits)
-            if i < MAX_GRAPH_CHUNKS - 1:  # Don't sleep after the last chunk
-                log.info("⏳ Sleeping 2s for API courtesy...")
-                await asyncio.sleep(5)
+        # Graph Extract (Concurrent + Rate Limited)
+        await stage("graph")
+        failed = await knowledge_graph.build_document_graph(document_id, user_id, chunks, check_cancelled=check_cancelled)
+        if failed == 0:
+            # กราฟครบ -> ไฟล์เดียวกันรอบหน้าคัดลอกจากเอกสารนี้ได้ (กราฟไม่ครบ -> รอบหน้าประมวลผลใหม่)
+            async with SessionLocal() as db:
+                await crud.mark_graph_complete(db, document_id)
 
         log.info(f"--- 🤖 TASK DONE (Doc ID: {document_id}) ---")
 
     except Exception as e:
         log.error(f"Error processing: {e}")
-    finally:
-        if os.path.exists(file_path): os.remove(file_path)
+        raise
 
 
 # --- Reranking Helper Function ---
-def rerank_chunks(query: str, chunks: list[models.Chunk], top_k: int = 5) -> list[models.Chunk]:
+async def rerank_chunks(query: str, chunks: list[models.Chunk], top_k: int = 5) -> list[models.Chunk]:
     """
     รับ Chunks จำนวนมาก -> ใช้ CrossEncoder ให้คะแนนเทียบกับ Query -> คืนค่า Top K
     """
     if not chunks:
         return []
     
-    # เตรียมข้อมูลคู่ (Query, Document Text)
-    pairs = [[query, chunk.text] for chunk in chunks]
-    
-    # ให้คะแนน (Scores)
-    scores = RERANKER_MODEL.predict(pairs)
+    # ให้คะแนน (Scores) -- ผ่าน RerankService (Worker Thread + Batching + Cache)
+    scores = await rerank_service.score(query, chunks)
     
     # จับคู่ Chunk กับ Score
     chunk_score_pairs = list(zip(chunks, scores))
@@ -124,66 +369,306 @@ def rerank_chunks(query: str, chunks: list[models.Chunk], top_k: int = 5) -> lis
     return top_chunks
 
 
+# --- Vector Search Parameters ---
+async def apply_vector_search_params(db, ef_search: int | None = None):
+    """
+    ตั้งค่า HNSW สำหรับ Transaction นี้ (SET LOCAL)
+    ef_search สูง = Recall ดีขึ้นแต่ช้าลง
+    """
+    ef_search = ef_search or settings.HNSW_EF_SEARCH
+    await db.execute(sa.select(sa.func.set_config("hnsw.ef_search", str(ef_search), True)))
+    if settings.HNSW_ITERATIVE_SCAN != "off":
+        # ให้ HNSW สแกนต่อถ้า Filter (owner_id/document_id) ตัดผลลัพธ์จนเหลือไม่ครบ LIMIT (pgvector >= 0.8)
+        await db.execute(sa.select(sa.func.set_config("hnsw.iterative_scan", settings.HNSW_ITERATIVE_SCAN, True)))
+
+
+# --- Stage 1: Hybrid Retrieval (Vector + Lexical) ---
+def _lexical_tsquery(query_text: str):
+    """
+    plainto_tsquery ใช้ AND ทุกคำ (คำถามยาวๆ จะไม่เจออะไรเลย) -> เปลี่ยนเป็น OR แล้วให้ ts_rank_cd จัดอันดับ
+    """
+    and_query = sa.cast(sa.func.plainto_tsquery("english", query_text), sa.Text)
+    return sa.cast(sa.func.replace(and_query, "&", "|"), TSQUERY)
+
+
+async def _first_stage_candidates(
+    db,
+    scope_filter,
+    query_text: str,
+    query_embedding,
+    limit: int
+) -> tuple[list[models.Chunk], dict[int, float]]:
+    """
+    ดึง Candidates ด้วย Vector Search และ Full-text Search แล้วรวมด้วย Reciprocal Rank Fusion
+    (ชื่อ Ticker / สินค้า / ตัวเลข ที่ Embedding จับได้ไม่ดี จะถูกดึงมาด้วย Lexical)
+    คืนค่า (candidates, {chunk_id: L2 distance}) -- Chunk ที่มาจาก Lexical อย่างเดียวจะไม่มี distance
+    """
+    distance = models.Chunk.embedding.l2_distance(query_embedding)
+    vector_stmt = (
+        sa.select(models.Chunk, distance.label("distance"))
+        .where(scope_filter)
+        .order_by(distance)
+        .limit(max(settings.HYBRID_VECTOR_CANDIDATES, limit))
+    )
+    vector_rows = (await db.execute(vector_stmt)).all()
+    vector_chunks = [row.Chunk for row in vector_rows]
+    distances = {row.Chunk.id: row.distance for row in vector_rows}
+    if not settings.HYBRID_SEARCH_ENABLED:
+        return vector_chunks[:limit], distances
+
+    ts_query = _lexical_tsquery(query_text)
+    lexical_stmt = (
+        sa.select(models.Chunk)
+        .where(scope_filter)
+        .where(models.Chunk.text_search.op("@@")(ts_query))
+        .order_by(sa.func.ts_rank_cd(models.Chunk.text_search, ts_query).desc())
+        .limit(max(settings.HYBRID_LEXICAL_CANDIDATES, limit))
+    )
+    lexical_chunks = (await db.execute(lexical_stmt)).scalars().all()
+
+    # RRF: score = sum(1 / (k + rank)) จากทุกรายการที่ Chunk นั้นอยู่
+    scores: dict[int, float] = {}
+    chunks_by_id: dict[int, models.Chunk] = {}
+    for ranked in (vector_chunks, lexical_chunks):
+        for rank, chunk in enumerate(ranked, start=1):
+            scores[chunk.id] = scores.get(chunk.id, 0.0) + 1.0 / (settings.HYBRID_RRF_K + rank)
+            chunks_by_id[chunk.id] = chunk
+
+    fused_ids = sorted(scores, key=scores.get, reverse=True)[:limit]
+    log.info(
+        f"Hybrid stage 1: {len(vector_chunks)} vector + {len(lexical_chunks)} lexical "
+        f"-> {len(fused_ids)} candidates"
+    )
+    return [chunks_by_id[chunk_id] for chunk_id in fused_ids], distances
+
+
+def _rerank_plan(
+    candidates: list[models.Chunk],
+    distances: dict[int, float],
+    options: schemas.RetrievalOptions
+) -> tuple[list[models.Chunk] | None, list[models.Chunk] | None]:
+    """
+    ตัดสินใจ Stage 2 ตาม options.rerank -> คืนค่า (chunks ที่ต้อง Rerank, ผลลัพธ์ที่ไม่ต้อง Rerank) อย่างใดอย่างหนึ่ง
+    - on:   Cross-Encoder ทุก Candidate
+    - off:  ใช้ลำดับจาก Stage 1 เลย
+    - auto: ถ้าอันดับ 1 (Vector) ทิ้งห่างชัดเจน -> ข้าม Rerank, ไม่งั้น Rerank เฉพาะกลุ่มที่ใกล้อันดับ 1
+    """
+    top_k = options.top_k or settings.RETRIEVAL_TOP_K
+    mode = options.rerank or settings.RERANK_MODE
+
+    if mode == "off" or not candidates:
+        return None, candidates[:top_k]
+
+    # ดูระยะเฉพาะ Candidate ที่ผ่าน RRF มา (ตัวที่ถูกตัดทิ้งจะไม่ถูก Rerank/คืนค่าอยู่แล้ว)
+    ranked = sorted(
+        ((chunk.id, distances[chunk.id]) for chunk in candidates if distances.get(chunk.id) is not None),
+        key=lambda item: item[1]
+    )
+    if mode == "auto" and ranked:
+        best_id, best_distance = ranked[0]
+        if len(ranked) == 1 or ranked[1][1] - best_distance >= settings.RERANK_AUTO_SKIP_GAP:
+            metrics.incr("rerank.auto.skipped")
+            log.info(f"Rerank skipped (decisive vector match, gap >= {settings.RERANK_AUTO_SKIP_GAP})")
+            ordered = sorted(candidates, key=lambda chunk: chunk.id != best_id) # อันดับ 1 ขึ้นก่อน
+            return None, ordered[:top_k]
+
+        cutoff = best_distance + settings.RERANK_AUTO_WINDOW
+        shortlist = [
+            chunk for chunk in candidates
+            if distances.get(chunk.id) is None or distances[chunk.id] <= cutoff
+        ]
+        if top_k <= len(shortlist) < len(candidates):
+            metrics.incr("rerank.auto.shortened")
+            return shortlist, None
+
+    return candidates, None
+
+
+async def _second_stage(
+    query_text: str,
+    candidates: list[models.Chunk],
+    distances: dict[int, float],
+    options: schemas.RetrievalOptions
+) -> list[models.Chunk]:
+    to_rerank, result = _rerank_plan(candidates, distances, options)
+    if to_rerank is None:
+        return result
+    return await rerank_chunks(query_text, to_rerank, top_k=options.top_k or settings.RETRIEVAL_TOP_K)
+
+
 # Retrieval (Global) - With Reranking
-async def retrieve_relevant_chunks_global(user_id: int, query_text: str) -> list[models.Chunk]:
-    log.info(f"Retrieving global (Stage 1: Vector Search)...")
-    query_embedding = EMBEDDING_MODEL.encode(query_text)
+async def retrieve_relevant_chunks_global(
+    user_id: int,
+    query_text: str,
+    options: schemas.RetrievalOptions | None = None
+) -> list[models.Chunk]:
+    log.info(f"Retrieving global (Stage 1: Hybrid Search)...")
+    options = options or schemas.RetrievalOptions()
+    query_embedding = await embedding_service.embed_query(query_text)
     
     async with SessionLocal() as db:
-        stmt = (
-            sa.select(models.Chunk)
-            .join(models.Document)
-            .where(models.Document.owner_id == user_id)
-            .order_by(models.Chunk.embedding.l2_distance(query_embedding))
-            .limit(20) # <--- ดึงมาเยอะๆ ก่อน (20)
+        await apply_vector_search_params(db, options.ef_search)
+        initial_chunks, distances = await _first_stage_candidates(
+            db,
+            models.Chunk.owner_id == user_id, # Denormalized -> ไม่ต้อง JOIN documents
+            query_text,
+            query_embedding,
+            options.candidates or settings.RERANK_CANDIDATES
         )
-        result = await db.execute(stmt)
-        initial_chunks = result.scalars().all()
         
     # Stage 2: Reranking
-    return rerank_chunks(query_text, initial_chunks, top_k=5) # คัดเหลือ 5
+    return await _second_stage(query_text, initial_chunks, distances, options)
 
 
 # Retrieval (Single Doc) - With Reranking
-async def retrieve_relevant_chunks(document_id: int, query_text: str) -> list[models.Chunk]:
-    log.info(f"Retrieving single doc (Stage 1: Vector Search)...")
-    query_embedding = EMBEDDING_MODEL.encode(query_text)
+async def retrieve_relevant_chunks(
+    document_id: int,
+    query_text: str,
+    options: schemas.RetrievalOptions | None = None
+) -> list[models.Chunk]:
+    log.info(f"Retrieving single doc (Stage 1: Hybrid Search)...")
+    options = options or schemas.RetrievalOptions()
+    query_embedding = await embedding_service.embed_query(query_text)
 
     async with SessionLocal() as db:
-        stmt = (
-            sa.select(models.Chunk)
-            .where(models.Chunk.document_id == document_id)
-            .order_by(models.Chunk.embedding.l2_distance(query_embedding))
-            .limit(20) # <--- ดึงมาเยอะๆ ก่อน (20)
+        await apply_vector_search_params(db, options.ef_search)
+        initial_chunks, distances = await _first_stage_candidates(
+            db,
+            models.Chunk.document_id == document_id,
+            query_text,
+            query_embedding,
+            options.candidates or settings.RERANK_CANDIDATES
         )
-        result = await db.execute(stmt)
-        initial_chunks = result.scalars().all()
 
     # Stage 2: Reranking
-    return rerank_chunks(query_text, initial_chunks, top_k=5) # คัดเหลือ 5
+    return await _second_stage(query_text, initial_chunks, distances, options)
+
+
+# Retrieval (Batch) - หลายคำถาม: encode ครั้งเดียว, DB Session เดียว, Rerank ครั้งเดียว
+async def retrieve_relevant_chunks_batch(
+    query_texts: list[str],
+    user_id: int,
+    doc_id: int | None = None,
+    options: schemas.RetrievalOptions | None = None
+) -> list[list[models.Chunk]]:
+    log.info(f"Retrieving batch of {len(query_texts)} questions (doc_id={doc_id})...")
+    options = options or schemas.RetrievalOptions()
+    top_k = options.top_k or settings.RETRIEVAL_TOP_K
+    query_embeddings = await embedding_service.embed_queries(query_texts)
+
+    if doc_id is not None:
+        scope_filter = models.Chunk.document_id == doc_id
+    else:
+        scope_filter = models.Chunk.owner_id == user_id
+
+    # Stage 1: ทุกคำถามใน Session/Transaction เดียว
+    plans = []
+    async with SessionLocal() as db:
+        await apply_vector_search_params(db, options.ef_search)
+        for query_text, query_embedding in zip(query_texts, query_embeddings):
+            candidates, distances = await _first_stage_candidates(
+                db, scope_filter, query_text, query_embedding,
+                options.candidates or settings.RERANK_CANDIDATES
+            )
+            plans.append(_rerank_plan(candidates, distances, options))
+
+    # Stage 2: รวม Pairs ของทุกคำถามที่ต้อง Rerank เป็น predict() ครั้งเดียว
+    rerank_indices = [i for i, (to_rerank, _) in enumerate(plans) if to_rerank]
+    all_scores = await rerank_service.score_many(
+        [(query_texts[i], plans[i][0]) for i in rerank_indices]
+    )
+
+    results = [result or [] for _, result in plans]
+    for i, scores in zip(rerank_indices, all_scores):
+        ranked = sorted(zip(plans[i][0], scores), key=lambda pair: pair[1], reverse=True)
+        results[i] = [chunk for chunk, _ in ranked[:top_k]]
+    log.info(f"Batch retrieval done. Reranked {len(rerank_indices)}/{len(query_texts)} questions")
+    return results
+
+
+# --- Query Pipeline: Retrieval + Graph Context พร้อมกัน ---
+async def _run_stage(stage: str, coro, timeout: float, default, timings: dict, swallow_errors: bool = False):
+    """
+    รัน 1 Branch ของ Query Pipeline พร้อม Timeout และบันทึกเวลาเป็น timings["<stage>_ms"]
+    Timeout -> คืนค่า default (ตอบต่อได้โดยไม่มีส่วนนี้)
+    """
+    start = time.perf_counter()
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        metrics.incr(f"query.{stage}.timeout")
+        log.warning(f"⏱️ Query stage '{stage}' timed out after {timeout:.1f}s")
+        return default
+    except Exception as e:
+        if not swallow_errors:
+            raise
+        log.error(f"Query stage '{stage}' failed: {e}")
+        return default
+    finally:
+        timings[f"{stage}_ms"] = elapsed_ms(start)
+
+
+async def gather_query_context(
+    query_text: str,
+    user_id: int,
+    doc_id: int | None = None,
+    options: schemas.RetrievalOptions | None = None,
+    timings: dict | None = None
+) -> tuple[list[models.Chunk], str]:
+    """
+    ดึง Context ทั้ง 2 ทางพร้อมกัน: (1) Vector Search + Rerank (2) GraphRAG
+    คืนค่า (relevant_chunks, graph_context)
+    """
+    timings = {} if timings is None else timings
+    if doc_id is not None:
+        retrieval = retrieve_relevant_chunks(document_id=doc_id, query_text=query_text, options=options)
+    else:
+        retrieval = retrieve_relevant_chunks_global(user_id=user_id, query_text=query_text, options=options)
+
+    relevant_chunks, graph_context = await asyncio.gather(
+        _run_stage("retrieval", retrieval, settings.QUERY_RETRIEVAL_TIMEOUT_SECONDS, [], timings),
+        fetch_graph_context(query_text, user_id, doc_id, timings),
+    )
+    return relevant_chunks, graph_context
+
+
+async def fetch_graph_context(query_text: str, user_id: int, doc_id: int | None = None, timings: dict | None = None) -> str:
+    """
+    GraphRAG Context พร้อม Timeout (Error/Timeout -> "")
+    """
+    return await _run_stage(
+        "graph",
+        knowledge_graph.query_graph_context(query_text, user_id, doc_id),
+        settings.QUERY_GRAPH_TIMEOUT_SECONDS,
+        "",
+        {} if timings is None else timings,
+        swallow_errors=True
+    )
 
 
 # generate_answer
-async def generate_answer(
-    query: str, 
+async def build_answer_messages(
+    query: str,
     context_chunks: list[models.Chunk],
     user_id: int,
-    doc_id: int = None
-) -> str:
+    doc_id: int = None,
+    graph_context: str | None = None
+) -> list[dict]:
     
     # 1. เตรียม Vector Context (Text Chunks)
     vector_context = "\n\n".join([chunk.text for chunk in context_chunks])
     
-    # 2. หา Graph Context (เรียกฟังก์ชันใหม่ที่เราเพิ่งเขียน)
-    log.info("Fetching GraphRAG context...")
-    try:
-        # ถ้ามี doc_id ให้หาเฉพาะใน doc นั้น, ถ้าไม่มีให้หาแบบ Global (แต่ต้องระวังเรื่อง Permission ในอนาคต)
-        # ในที่นี้เอาแบบง่ายก่อน คือถ้าเป็น Global Chat (doc_id=None) เราค้นทั้งกราฟเลย
-        # หรือน้องจะส่ง user_id ไปกรองใน Knowledge Graph ก็ได้ (Task Advance)
-        graph_context = await knowledge_graph.query_graph_context(query, user_id, doc_id)
-    except Exception as e:
-        log.error(f"GraphRAG failed: {e}")
-        graph_context = ""
+    # 2. หา Graph Context (ถ้ายังไม่ได้ดึงมาพร้อม Retrieval ใน gather_query_context)
+    if graph_context is None:
+        log.info("Fetching GraphRAG context...")
+        try:
+            # ถ้ามี doc_id ให้หาเฉพาะใน doc นั้น, ถ้าไม่มีให้หาแบบ Global (แต่ต้องระวังเรื่อง Permission ในอนาคต)
+            # ในที่นี้เอาแบบง่ายก่อน คือถ้าเป็น Global Chat (doc_id=None) เราค้นทั้งกราฟเลย
+            # หรือน้องจะส่ง user_id ไปกรองใน Knowledge Graph ก็ได้ (Task Advance)
+            graph_context = await knowledge_graph.query_graph_context(query, user_id, doc_id)
+        except Exception as e:
+            log.error(f"GraphRAG failed: {e}")
+            graph_context = ""
 
     log.info(f"Generating answer using {len(context_chunks)} chunks + Graph Context.")
 
@@ -210,15 +695,30 @@ async def generate_answer(
     {query}
     """
 
+    return [
+        {"role": "system", "content": "You are a helpful analyst."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+ANSWER_ERROR_MESSAGE = "Error generating response."
+
+
+async def generate_answer(
+    query: str, 
+    context_chunks: list[models.Chunk],
+    user_id: int,
+    doc_id: int = None,
+    graph_context: str | None = None
+) -> str:
+    messages = await build_answer_messages(query, context_chunks, user_id, doc_id, graph_context)
+
     @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
     async def call_llm_api():
         return await acompletion(
             model=f"{settings.LLM_PROVIDER}/llama-3.1-8b-instant",
             api_key=settings.LLM_API_KEY,
-            messages=[
-                {"role": "system", "content": "You are a helpful analyst."},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             temperature=0.0
         )
 
@@ -227,5 +727,39 @@ async def generate_answer(
         return response.choices[0].message.content
     except Exception as e:
         log.error(f"Generation failed: {e}")
-        return "Error generating response."
+        return ANSWER_ERROR_MESSAGE
+
+
+async def stream_answer(
+    query: str,
+    context_chunks: list[models.Chunk],
+    user_id: int,
+    doc_id: int = None,
+    graph_context: str | None = None
+) -> AsyncIterator[str]:
+    """
+    เหมือน generate_answer แต่ yield ข้อความทีละส่วน (Token delta) ทันทีที่ LLM ส่งมา
+    Retry เฉพาะตอนเปิด Stream -- ถ้าขาดกลางทางจะ yield ข้อความ Error ต่อท้าย
+    """
+    messages = await build_answer_messages(query, context_chunks, user_id, doc_id, graph_context)
+
+    @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+    async def open_llm_stream():
+        return await acompletion(
+            model=f"{settings.LLM_PROVIDER}/llama-3.1-8b-instant",
+            api_key=settings.LLM_API_KEY,
+            messages=messages,
+            temperature=0.0,
+            stream=True
+        )
+
+    try:
+        stream = await open_llm_stream()
+        async for part in stream:
+            delta = part.choices[0].delta.content if part.choices else None
+            if delta:
+                yield delta
+    except Exception as e:
+        log.error(f"Streaming generation failed: {e}")
+        yield ANSWER_ERROR_MESSAGE
     
\ No newline at end of file
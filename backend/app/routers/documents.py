@@ -1,7 +1,10 @@
+import json
 from typing import Annotated
-from fastapi import APIRouter, Depends, File, UploadFile, status
+from fastapi import APIRouter, Depends, File, Header, Query, Response, UploadFile, status
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from app import models, schemas
+from app import models, schemas, graph_cache
+from app.config import settings
 from app.database import get_db
 from app.dependencies import get_current_user
 from app.controllers import document_controller
@@ -11,6 +14,34 @@ router = APIRouter(
     tags=["Documents"]
 )
 
+async def _sse_stream(events):
+    """
+    แปลง (event, data) จาก Controller เป็น Server-Sent Events
+    """
+    async for event, data in events:
+        if event == "context":
+            data = [schemas.Chunk.model_validate(chunk).model_dump() for chunk in data]
+        elif event == "token":
+            data = {"delta": data}
+        yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        _sse_stream(events),
+        media_type="text/event-stream",
+        # ปิด Buffer ของ Proxy (เช่น Nginx) ไม่งั้น Client จะได้ทีเดียวตอนจบ
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _batch_response(questions: list[str], results: list, timings: dict) -> schemas.BatchQueryResponse:
+    return schemas.BatchQueryResponse(
+        results=[
+            schemas.BatchQueryItem(question=question, answer=answer, context=context, timings=item_timings)
+            for question, (answer, context, item_timings) in zip(questions, results)
+        ],
+        timings=timings
+    )
+
 @router.post("/", response_model=schemas.Document)
 async def create_document_and_upload_file(
     db: AsyncSession = Depends(get_db), 
@@ -41,10 +72,10 @@ async def query_document(
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    answer, context = await document_controller.query_document(
-        doc_id, request.question, db, current_user
+    answer, context, timings = await document_controller.query_document(
+        doc_id, request.question, db, current_user, options=request
     )
-    return schemas.QueryResponse(answer=answer, context=context)
+    return schemas.QueryResponse(answer=answer, context=context, timings=timings)
 
 @router.post("/query", response_model=schemas.QueryResponse)
 async def query_all_documents(
@@ -52,10 +83,56 @@ async def query_all_documents(
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    answer, context = await document_controller.query_all_documents(
-        request.question, db, current_user
+    answer, context, timings = await document_controller.query_all_documents(
+        request.question, db, current_user, options=request
+    )
+    return schemas.QueryResponse(answer=answer, context=context, timings=timings)
+
+@router.post("/{doc_id}/query/batch", response_model=schemas.BatchQueryResponse)
+async def query_document_batch(
+    doc_id: int,
+    request: schemas.BatchQueryRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    results, timings = await document_controller.query_document_batch(
+        doc_id, request.questions, db, current_user, options=request
+    )
+    return _batch_response(request.questions, results, timings)
+
+@router.post("/query/batch", response_model=schemas.BatchQueryResponse)
+async def query_all_documents_batch(
+    request: schemas.BatchQueryRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    results, timings = await document_controller.query_all_documents_batch(
+        request.questions, db, current_user, options=request
+    )
+    return _batch_response(request.questions, results, timings)
+
+@router.post("/{doc_id}/query/stream")
+async def stream_query_document(
+    doc_id: int,
+    request: schemas.QueryRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    events = await document_controller.stream_query_document(
+        doc_id, request.question, db, current_user, options=request
+    )
+    return _sse_response(events)
+
+@router.post("/query/stream")
+async def stream_query_all_documents(
+    request: schemas.QueryRequest,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    events = await document_controller.stream_query_all_documents(
+        request.question, db, current_user, options=request
     )
-    return schemas.QueryResponse(answer=answer, context=context)
+    return _sse_response(events)
 
 @router.delete("/{doc_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_document(
@@ -72,23 +149,49 @@ async def query_all_documents(
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    answer, context = await document_controller.query_all_documents(
-        request.question, db, current_user
+    answer, context, timings = await document_controller.query_all_documents(
+        request.question, db, current_user, options=request
     )
-    return schemas.QueryResponse(answer=answer, context=context)
+    return schemas.QueryResponse(answer=answer, context=context, timings=timings)
 
 @router.post("/fetch-sec")
 async def fetch_sec_document(
     req: schemas.SecRequest,
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    await document_controller.fetch_sec_document(req.ticker, current_user)
-    return {"message": f"Started fetching 10-K for {req.ticker}. Check your documents list in a few minutes."}
+    db_doc = await document_controller.fetch_sec_document(req.ticker, db, current_user)
+    return {
+        "message": f"Started fetching 10-K for {req.ticker}. Check your documents list in a few minutes.",
+        "document_id": db_doc.id
+    }
+
+@router.get("/{doc_id}/status", response_model=schemas.DocumentStatus)
+async def read_document_status(
+    doc_id: int,
+    db: AsyncSession = Depends(get_db),
+    current_user: models.User = Depends(get_current_user)
+):
+    return await document_controller.get_document_status(doc_id, db, current_user)
 
 @router.get("/{doc_id}/graph", response_model=schemas.GraphData)
 async def get_document_graph_data(
     doc_id: int,
+    cursor: str | None = None,
+    limit: int = Query(default=settings.GRAPH_PAGE_SIZE, ge=1, le=settings.GRAPH_PAGE_MAX_SIZE),
+    if_none_match: str | None = Header(default=None),
+    accept: str | None = Header(default=None),
     db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
-    return await document_controller.get_graph_data(doc_id, db, current_user)
+    # Accept: application/x-msgpack -> แบบ Compact (Columnar + Interned ids) ดู graph_cache.to_compact
+    media_type = graph_cache.negotiate_media_type(accept)
+    etag, body = await document_controller.get_graph_data(
+        doc_id, db, current_user, cursor, limit, if_none_match, media_type
+    )
+    # private: เป็นข้อมูลของ User นี้ / no-cache: Browser ต้องถามใหม่ทุกครั้ง (ได้ 304 ถ้ายังไม่เปลี่ยน)
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"} if etag else {"Cache-Control": "no-store"}
+    headers["Vary"] = "Accept"
+    if body is None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type=media_type, headers=headers)
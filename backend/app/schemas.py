@@ -1,6 +1,7 @@
 from pydantic import BaseModel, EmailStr
 from pydantic import BaseModel, EmailStr, Field
 import datetime
+from typing import Literal
 
 # --- Pydantic Models (Schemas) ---
 
@@ -68,14 +69,37 @@ class Chunk(BaseModel):
     class Config:
         from_attributes = True
 
+# ปรับการค้นหาต่อ Request (None = ใช้ค่า Default จาก Settings)
+class RetrievalOptions(BaseModel):
+    # HNSW ef_search สำหรับ Request นี้ (สูง = แม่นขึ้นแต่ช้าลง)
+    ef_search: int | None = Field(default=None, ge=1, le=1000)
+    # จำนวน Candidates ที่ส่งให้ Reranker
+    candidates: int | None = Field(default=None, ge=1, le=100)
+    # จำนวน Chunks ที่ใช้ตอบ
+    top_k: int | None = Field(default=None, ge=1, le=20)
+    rerank: Literal["on", "off", "auto"] | None = None
+
 # รับคำถาม
-class QueryRequest(BaseModel):
+class QueryRequest(RetrievalOptions):
     question: str
 
 # ส่งคำตอบ + บริบท
 class QueryResponse(BaseModel):
     answer: str
     context: list[Chunk] # Reuse schema 'Chunk' ที่มีอยู่แล้ว
+    # เวลาแต่ละขั้นของ Query Pipeline (ms) เช่น retrieval_ms, graph_ms, generation_ms, total_ms
+    timings: dict[str, float] = {}
+
+# รับคำถามหลายข้อ (Question Battery) -- Retrieval options ใช้ร่วมกันทุกข้อ
+class BatchQueryRequest(RetrievalOptions):
+    questions: list[str] = Field(min_length=1, max_length=50)
+
+class BatchQueryItem(QueryResponse):
+    question: str
+
+class BatchQueryResponse(BaseModel):
+    results: list[BatchQueryItem]
+    timings: dict[str, float] = {}
 
 class GraphNode(BaseModel):
     id: str
@@ -90,6 +114,18 @@ class GraphEdge(BaseModel):
 class GraphData(BaseModel):
     nodes: list[GraphNode]
     edges: list[GraphEdge]
+    # ส่งกลับมาเป็น ?cursor= เพื่อดึงหน้าถัดไป (None = หน้าสุดท้าย)
+    next_cursor: str | None = None
+
+# สถานะการประมวลผลเอกสาร (จาก Job Queue)
+class DocumentStatus(BaseModel):
+    document_id: int
+    status: str # queued / running / done / failed / cancelled
+    stage: str | None = None # downloading / copying / extracting / embedding / graph
+    attempts: int = 0
+    max_attempts: int = 0
+    last_error: str | None = None
+    updated_at: datetime.datetime | None = None
 
 class SecRequest(BaseModel):
     ticker: str # เช่น TSLA, AAPL, NVDA
\ No newline at end of file
@@ -1,11 +1,11 @@
+import asyncio
 import os
 import shutil
 import glob
 from sec_edgar_downloader import Downloader
 from bs4 import BeautifulSoup
 from app.config import settings
-from app import processing, crud, models
-from app.database import SessionLocal
+from app import processing
 import logging
 import re
 from app.utils import smart_crop_content
@@ -70,7 +70,18 @@ def clean_html_content(raw_content: str) -> str:
     
     return text
 
-async def fetch_and_process_10k(user_id: int, ticker: str, amount: int = 1):
+async def fetch_and_process_10k(
+    user_id: int,
+    ticker: str,
+    document_id: int,
+    amount: int = 1,
+    report_stage=None,
+    check_cancelled=None
+):
+    """
+    ดาวน์โหลด 10-K -> Clean -> ส่งต่อให้ Pipeline ของ Document ที่สร้างไว้แล้ว (document_id)
+    ถูกเรียกจาก Job Queue -- ถ้า Error จะ raise ออกไปเพื่อให้คิว Retry
+    """
     ticker = ticker.upper()
     log.info(f"🔍 Fetching 10-K for {ticker}...")
 
@@ -83,14 +94,17 @@ async def fetch_and_process_10k(user_id: int, ticker: str, amount: int = 1):
     dl = Downloader("Investi-Graph", settings.SEC_API_EMAIL, TEMP_SEC_DIR)
 
     try:
-        dl.get("10-K", ticker, limit=amount)
+        if report_stage is not None:
+            await report_stage("downloading")
+
+        # Downloader เป็น Sync (Network I/O) -> รันใน Thread เพื่อไม่ให้ Event Loop ค้าง
+        await asyncio.to_thread(dl.get, "10-K", ticker, limit=amount)
         
         search_path = os.path.join(TEMP_SEC_DIR, "sec-edgar-filings", ticker, "10-K", "*", "*.txt")
         files = glob.glob(search_path)
         
         if not files:
-            log.error(f"No 10-K found for {ticker}")
-            return
+            raise FileNotFoundError(f"No 10-K found for {ticker}")
         
         files.sort(reverse=True)
 
@@ -101,9 +115,9 @@ async def fetch_and_process_10k(user_id: int, ticker: str, amount: int = 1):
         with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
             raw_content = f.read()
             
-        # --- 4. Clean HTML ก่อนใช้งาน ---
+        # --- 4. Clean HTML ก่อนใช้งาน (CPU หนัก -> รันใน Thread) ---
         log.info("🧹 Cleaning HTML content...")
-        clean_text = clean_html_content(raw_content)
+        clean_text = await asyncio.to_thread(clean_html_content, raw_content)
         clean_text = smart_crop_content(clean_text)
         log.info(f"Cleaned text length: {len(clean_text)}")
         
@@ -112,22 +126,22 @@ async def fetch_and_process_10k(user_id: int, ticker: str, amount: int = 1):
         filename = f"{ticker}_10K_Report.txt"
 
         # 5. ส่งต่อให้ Pipeline (เหมือนเดิม)
-        async with SessionLocal() as db:
-            db_doc = await crud.create_document(db=db, filename=filename, owner_id=user_id)
-            
-            await processing.save_extract_chunk_and_embed(
-                document_id=db_doc.id,
-                user_id=user_id,
-                filename=filename,
-                content_type="text/plain", # ตอนนี้เป็น Text ล้วนแล้ว
-                content=content_bytes
-            )
+        await processing.save_extract_chunk_and_embed(
+            document_id=document_id,
+            user_id=user_id,
+            filename=filename,
+            content_type="text/plain", # ตอนนี้เป็น Text ล้วนแล้ว
+            content=content_bytes,
+            report_stage=report_stage,
+            check_cancelled=check_cancelled
+        )
 
         log.info(f"✅ SEC Fetch & Process Complete for {ticker}")
 
     except Exception as e:
         log.error(f"❌ Error fetching SEC data: {e}")
+        raise
     
     finally:
         if os.path.exists(os.path.join(TEMP_SEC_DIR, "sec-edgar-filings", ticker)):
-             shutil.rmtree(os.path.join(TEMP_SEC_DIR, "sec-edgar-filings", ticker))
\ No newline at end of file
+             shutil.rmtree(os.path.join(TEMP_SEC_DIR, "sec-edgar-filings", ticker))
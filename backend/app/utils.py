@@ -1,9 +1,37 @@
 import re
+import hashlib
 import logging
+import time
 
 # สร้าง Logger
 log = logging.getLogger("uvicorn.error")
 
+def content_hash(data: bytes | str) -> str:
+    """
+    SHA-256 (hex) ของเนื้อหา -- ใช้เป็น Key สำหรับ Dedup ไฟล์และ Chunks
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def normalize_query(text: str) -> str:
+    """
+    ทำให้คำถามที่ต่างกันแค่ตัวพิมพ์/ช่องว่าง กลายเป็น Key เดียวกัน (ใช้กับ Cache)
+    """
+    return " ".join(text.lower().split())
+
+def estimate_tokens(text: str) -> int:
+    """
+    ประมาณจำนวน Token แบบเร็ว (~4 ตัวอักษรต่อ Token สำหรับภาษาอังกฤษ)
+    """
+    return len(text) // 4 + 1
+
+def elapsed_ms(start: float) -> float:
+    """
+    เวลาที่ผ่านไปตั้งแต่ start (ค่าจาก time.perf_counter()) หน่วยมิลลิวินาที
+    """
+    return round((time.perf_counter() - start) * 1000, 1)
+
 def is_looks_like_toc(text_snippet: str) -> bool:
     """
     Helper Function: ตรวจสอบว่าข้อความสั้นๆ นี้ดูเหมือนสารบัญหรือไม่
@@ -0,0 +1,100 @@
+"""
+Benchmark: PDF text extraction (เดิม vs ใหม่)
+
+- legacy: เขียนไฟล์ลงดิสก์ -> PdfReader(path) -> extracted_text += page.extract_text() (ทีละหน้า, Process เดียว)
+- thread: app.pdf_extraction.extract_pdf_text (อ่านจาก Memory ใน Thread, join ครั้งเดียว)
+
+Usage (รันจากโฟลเดอร์ backend/ ที่มี .env):
+    python bench_pdf_extraction.py path/to/10k.pdf
+    python bench_pdf_extraction.py --pages 400      # สร้าง PDF สังเคราะห์ขนาด 400 หน้า
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# Add the project root to sys.path
+sys.path.append(os.getcwd())
+
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from app import pdf_extraction
+
+
+def build_synthetic_pdf(pages: int, lines_per_page: int = 60) -> bytes:
+    """สร้าง PDF ที่มีข้อความเต็มหน้า (ใกล้เคียง 10-K) สำหรับทดสอบ"""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for page_no in range(pages):
+        page = writer.add_blank_page(612, 792)
+        lines = [
+            f"({page_no}:{line_no} The Company faces risks related to supply chain, competition and regulation.) '"
+            for line_no in range(lines_per_page)
+        ]
+        stream = DecodedStreamObject()
+        stream.set_data(("BT /F1 9 Tf 11 TL 40 770 Td " + " ".join(lines) + " ET").encode("latin-1"))
+        page[NameObject("/Contents")] = writer._add_object(stream)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+        })
+
+    buffer = tempfile.SpooledTemporaryFile()
+    writer.write(buffer)
+    buffer.seek(0)
+    return buffer.read()
+
+
+def legacy_extract(content: bytes) -> str:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, "doc.pdf")
+        with open(file_path, "wb") as out_file:
+            out_file.write(content)
+        extracted_text = ""
+        reader = PdfReader(file_path)
+        for page in reader.pages:
+            extracted_text += page.extract_text() + "\n"
+        return extracted_text
+
+
+def measure(label: str, fn) -> str:
+    # จับเวลาแยกจากการวัด Memory (tracemalloc ทำให้โค้ดใน process หลักช้าลงมาก)
+    start = time.perf_counter()
+    text = fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} wall={elapsed:8.2f}s  peak_py_mem={peak / 1024 / 1024:8.1f} MiB  chars={len(text):,}")
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdf", nargs="?", help="PDF file to benchmark (default: synthetic)")
+    parser.add_argument("--pages", type=int, default=300, help="pages for the synthetic PDF")
+    args = parser.parse_args()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            content = f.read()
+    else:
+        print(f"Building synthetic PDF with {args.pages} pages...")
+        content = build_synthetic_pdf(args.pages)
+    print(f"PDF size: {len(content) / 1024 / 1024:.1f} MiB\n")
+
+    measure("legacy", lambda: legacy_extract(content))
+    measure("thread", lambda: asyncio.run(pdf_extraction.extract_pdf_text(content)))
+
+
+if __name__ == "__main__":
+    main()